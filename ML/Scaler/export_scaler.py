@@ -1,10 +1,10 @@
-from data import CSVDataset
+from stats import fit_scaler
+from ingest import list_sessions
 from utils import Config
 
 import json
 import os
 import argparse
-from shutil import copy, rmtree
 
 if __name__=='__main__':
     parser = argparse.ArgumentParser()
@@ -62,22 +62,21 @@ if __name__=='__main__':
         'relativeTracker1Posz',
         ]
     if args.csv_file:
-        os.makedirs('tmp/', exist_ok=True)
-        copy(args.csv_file, 'tmp/.')
-        dataset = CSVDataset(root_path='tmp')
-        rmtree('tmp/')
+        paths = [args.csv_file]
     else:
-        dataset = CSVDataset(root_path=Config['dataset_path'])
+        paths = [os.path.join(Config['dataset_path'], f) for f in list_sessions(Config['dataset_path'])]
+    # merged from the per-session stats sidecars, only sessions without up to date stats are read
+    scaler = fit_scaler(paths, feature_range=(0,1))
     with open(os.path.join('scaler.json'), 'w') as f:
-        scaler = {'scalers': []}
+        scaler_json = {'scalers': []}
         for idx, header in enumerate(headers):
-            scaler['scalers'].append({
+            scaler_json['scalers'].append({
                 'type': header,
-                'min': dataset.scaler.min_.tolist()[idx],
-                'scale':dataset.scaler.scale_.tolist()[idx],
-                'data_min':dataset.scaler.data_min_.tolist()[idx],
-                'data_max': dataset.scaler.data_max_.tolist()[idx],
-                'data_range': dataset.scaler.data_range_.tolist()[idx],
-                'n_samples_seen': dataset.scaler.n_samples_seen_
+                'min': scaler.min_.tolist()[idx],
+                'scale':scaler.scale_.tolist()[idx],
+                'data_min':scaler.data_min_.tolist()[idx],
+                'data_max': scaler.data_max_.tolist()[idx],
+                'data_range': scaler.data_range_.tolist()[idx],
+                'n_samples_seen': int(scaler.n_samples_seen_)
             })
-        json.dump(scaler, f)
\ No newline at end of file
+        json.dump(scaler_json, f)
\ No newline at end of file
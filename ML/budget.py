@@ -0,0 +1,131 @@
+import torch
+
+import time
+
+from utils import Config
+
+
+def make_scheduler(optimizer, kind=Config['lr_schedule'], num_epochs=Config['num_epochs'], steps_per_epoch=None, mode='min'):
+    """LR schedule of a run by name
+
+    Args-
+        optimizer- Optimizer whose lr is scheduled, its current lr is the peak lr of 'onecycle'
+        kind- None, 'plateau', 'onecycle' or 'cosine'
+        num_epochs- Epoch budget of the run, the length of the 'onecycle' and 'cosine' schedules
+        steps_per_epoch- Batches per epoch, required by 'onecycle'
+        mode- 'min' or 'max', direction of the result passed to the 'plateau' schedule
+
+    Returns-
+        The scheduler, or None when kind is None
+    """
+    if kind is None:
+        return None
+    if kind == 'plateau':
+        return torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode=mode, factor=Config['plateau_factor'],
+                                                          patience=Config['plateau_patience'])
+    if kind == 'cosine':
+        return torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=num_epochs)
+    if kind == 'onecycle':
+        if steps_per_epoch is None:
+            raise ValueError('The onecycle schedule needs the number of batches per epoch')
+        return torch.optim.lr_scheduler.OneCycleLR(optimizer, max_lr=[group['lr'] for group in optimizer.param_groups],
+                                                   epochs=num_epochs, steps_per_epoch=steps_per_epoch)
+    raise ValueError(f'Unknown lr schedule {kind}')
+
+
+def steps_per_batch(scheduler):
+    # OneCycleLR is defined over batches, every other schedule over epochs
+    return isinstance(scheduler, torch.optim.lr_scheduler.OneCycleLR)
+
+
+def step_scheduler(scheduler, value):
+    """Steps an epoch based scheduler once, passing the monitored validation result to ReduceLROnPlateau"""
+    if isinstance(scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau):
+        scheduler.step(value)
+    else:
+        scheduler.step()
+
+
+class BudgetController:
+    """Decides when Trainer.fit stops before its epoch budget.
+
+    Training stops once the monitored validation result did not improve by
+    more than min_delta for patience epochs, or once the wall-clock budget is
+    spent. The time and epoch at which the validation loss first reached
+    target are recorded. Time spent before a resume is carried over through
+    state_dict().
+
+    Args-
+        monitor- Validation result early stopping watches
+        mode- 'min' or 'max', whether a lower or a higher monitor value is better
+        patience- Epochs without improvement before stopping, None to disable early stopping
+        min_delta- Smallest change of the monitored result that counts as an improvement
+        max_time- Wall-clock budget in seconds, None for no limit
+        target- Validation loss whose time to reach is recorded, None to disable
+    """
+    def __init__(self, monitor='loss', mode='min', patience=Config['early_stopping_patience'],
+                 min_delta=Config['early_stopping_min_delta'], max_time=Config['max_train_time'],
+                 target=Config['target_loss']):
+        self.monitor = monitor
+        self.mode = mode
+        self.patience = patience
+        self.min_delta = min_delta
+        self.max_time = max_time
+        self.target = target
+        self.best = None
+        self.bad_epochs = 0
+        self.elapsed = 0.0
+        self.time_to_target = None
+        self.epoch_to_target = None
+        self.stop_reason = None
+        self.start()
+
+    def start(self):
+        self.started = time.monotonic()
+
+    def elapsed_time(self):
+        return self.elapsed + time.monotonic() - self.started
+
+    def improved(self, value):
+        if self.best is None:
+            return True
+        if self.mode == 'min':
+            return value < self.best - self.min_delta
+        return value > self.best + self.min_delta
+
+    def update(self, epoch, results):
+        """Records the validation results of epoch, returns True when training should stop"""
+        if self.target is not None and self.time_to_target is None and results['loss'] <= self.target:
+            self.time_to_target = self.elapsed_time()
+            self.epoch_to_target = epoch
+            print(f'Reached validation loss {self.target} after {self.time_to_target:.1f}s (epoch {epoch})')
+
+        value = results[self.monitor]
+        if self.improved(value):
+            self.best = value
+            self.bad_epochs = 0
+        else:
+            self.bad_epochs += 1
+
+        if self.patience is not None and self.bad_epochs >= self.patience:
+            self.stop_reason = f'no improvement of {self.monitor} for {self.bad_epochs} epochs'
+        elif self.max_time is not None and self.elapsed_time() >= self.max_time:
+            self.stop_reason = f'time budget of {self.max_time}s spent'
+        return self.stop_reason is not None
+
+    def state_dict(self):
+        return {
+            'best': self.best,
+            'bad_epochs': self.bad_epochs,
+            'elapsed': self.elapsed_time(),
+            'time_to_target': self.time_to_target,
+            'epoch_to_target': self.epoch_to_target
+        }
+
+    def load_state_dict(self, state):
+        self.best = state['best']
+        self.bad_epochs = state['bad_epochs']
+        self.elapsed = state['elapsed']
+        self.time_to_target = state['time_to_target']
+        self.epoch_to_target = state['epoch_to_target']
+        self.start()
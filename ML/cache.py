@@ -0,0 +1,133 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from utils import Config
+
+# Bumped whenever the cache layout changes, older caches are rebuilt
+CACHE_VERSION = 1
+
+
+def cache_dir(path):
+    key = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+    return os.path.join(Config['cache_path'], key)
+
+
+def signature(path):
+    stat = os.stat(path)
+    return {
+        'version': CACHE_VERSION,
+        'source': os.path.abspath(path),
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size
+    }
+
+
+def load_meta(path):
+    """Returns the cache metadata of a session, or None if the cache is missing or stale"""
+    sig = signature(path)
+    try:
+        with open(os.path.join(cache_dir(path), 'meta.json'), 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    for key, value in sig.items():
+        if meta.get(key) != value:
+            return None
+    return meta
+
+
+def build_cache(path):
+    """Parses a session CSV once and stores every column as its own .npy file.
+
+    Numeric columns keep the dtype pandas inferred for them, string columns
+    (gesture, key, hand, ...) are stored as category codes plus their categories.
+    """
+    sig = signature(path)
+    csv_data = pd.read_csv(path)
+    directory = cache_dir(path)
+    os.makedirs(directory, exist_ok=True)
+
+    columns = []
+    for idx, name in enumerate(csv_data.columns):
+        series = csv_data[name]
+        entry = {'name': name, 'file': f'{idx}.npy'}
+        if pd.api.types.is_numeric_dtype(series):
+            values = series.to_numpy()
+        else:
+            categorical = series.astype('category')
+            values = categorical.cat.codes.to_numpy()
+            entry['categories'] = categorical.cat.categories.tolist()
+        np.save(os.path.join(directory, entry['file']), values)
+        columns.append(entry)
+
+    meta = dict(sig, num_rows=len(csv_data), columns=columns)
+    # meta.json is written last so an interrupted build is never picked up
+    tmp_path = os.path.join(directory, 'meta.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(directory, 'meta.json'))
+    return meta
+
+
+def select_columns(names, columns=None):
+    """Resolves a column projection (None, slice, positions or names) to positions"""
+    if columns is None:
+        return list(range(len(names)))
+    if isinstance(columns, slice):
+        return list(range(len(names)))[columns]
+    return [names.index(c) if isinstance(c, str) else c for c in columns]
+
+
+def load_column(path, entry, rows=slice(None)):
+    values = np.load(os.path.join(cache_dir(path), entry['file']), mmap_mode='r')[rows]
+    if 'categories' not in entry:
+        return values
+    categories = np.asarray(entry['categories'] + [np.nan], dtype=object)
+    # code -1 marks a missing value and picks the trailing NaN
+    return categories[values]
+
+
+def session_columns(path, columns=None):
+    """Returns the cache entries of the projected columns, building the cache first if needed"""
+    meta = load_meta(path)
+    if meta is None:
+        meta = build_cache(path)
+    entries = meta['columns']
+    names = [entry['name'] for entry in entries]
+    return [entries[idx] for idx in select_columns(names, columns)], meta['num_rows']
+
+
+def read_session(path, columns=None):
+    """Reads a recorded session CSV through the columnar cache.
+
+    Args-
+        path- Path of the session CSV
+        columns- Optional projection, either a slice of column positions
+            (e.g. slice(1, 41) for .iloc[:, 1:41]) or a list of names/positions
+
+    Returns-
+        A DataFrame equal to pd.read_csv(path).iloc[:, columns]
+    """
+    if not Config['use_cache']:
+        csv_data = pd.read_csv(path)
+        return csv_data.iloc[:, select_columns(list(csv_data.columns), columns)]
+
+    selected, _ = session_columns(path, columns)
+    return pd.DataFrame({entry['name']: load_column(path, entry) for entry in selected})
+
+
+def iter_session(path, columns=None, chunk_rows=65536):
+    """Reads a session in chunks of at most chunk_rows rows, so only one chunk is held in memory"""
+    if not Config['use_cache']:
+        for csv_data in pd.read_csv(path, chunksize=chunk_rows):
+            yield csv_data.iloc[:, select_columns(list(csv_data.columns), columns)].reset_index(drop=True)
+        return
+
+    selected, num_rows = session_columns(path, columns)
+    for start in range(0, num_rows, chunk_rows):
+        rows = slice(start, start + chunk_rows)
+        yield pd.DataFrame({entry['name']: load_column(path, entry, rows) for entry in selected})
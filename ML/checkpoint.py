@@ -0,0 +1,383 @@
+import torch
+import numpy as np
+
+import os
+import copy
+import json
+import queue
+import random
+import hashlib
+import argparse
+import threading
+
+from utils import Config
+
+try:
+    import onnx
+except ImportError:
+    onnx = None
+
+
+def snapshot(model, out=None):
+    """Copies the state_dict of a model to CPU tensors, pinned when training on a GPU.
+
+    Args-
+        model- Model whose weights are copied
+        out- Optional earlier snapshot of the same model, its buffers are reused
+
+    Returns-
+        A state_dict of CPU tensors that later training steps don't modify
+    """
+    state = model.state_dict()
+    if out is None:
+        pin = torch.cuda.is_available()
+        out = {key: torch.empty_like(value, device='cpu', pin_memory=pin and value.is_cuda)
+               for key, value in state.items()}
+    for key, value in state.items():
+        out[key].copy_(value.detach(), non_blocking=True)
+    if any(value.is_cuda for value in state.values()):
+        torch.cuda.synchronize()
+    return out
+
+
+def to_cpu(obj):
+    """Copies every tensor of a (nested) state, e.g. an optimizer state_dict, to the CPU"""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return copy.deepcopy(obj)
+
+
+def rng_state():
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def training_state_path(name=''):
+    return os.path.join(Config['model_path'], 'checkpoints', name, 'resume.pth')
+
+
+def load_training_state(name=''):
+    """The last training state saved by Trainer.fit for a run, or None if there is none"""
+    path = training_state_path(name)
+    if not os.path.exists(path):
+        return None
+    # holds RNG states and numbers besides tensors
+    return torch.load(path, weights_only=False)
+
+
+def tensor_digest(tensor):
+    """sha256 of the dtype, shape and bytes of a CPU tensor"""
+    digest = hashlib.sha256(f'{tensor.dtype}{tuple(tensor.shape)}'.encode('utf-8'))
+    digest.update(tensor.detach().contiguous().reshape(-1).view(torch.uint8).numpy())
+    return digest.hexdigest()
+
+
+class CheckpointStore:
+    """Content-addressed store of the periodic checkpoints of a run.
+
+    Every tensor is saved once under objects/<sha256>.pt and a checkpoint is an
+    entry of index.json mapping its state_dict keys to tensor hashes, so tensors
+    shared by several checkpoints are written only once. Only the top_k
+    checkpoints by the monitored validation result and the keep_last latest
+    ones are retained, together with their ONNX export, objects that no
+    retained checkpoint refers to are deleted.
+
+    Args-
+        root- Directory of the store, e.g. <model_path>/checkpoints
+        monitor- Validation result the checkpoints are ranked by
+        mode- 'min' or 'max', whether a lower or a higher monitor value is better
+        top_k- Number of best checkpoints to keep
+        keep_last- Number of latest checkpoints to keep
+    """
+    def __init__(self, root, monitor='loss', mode='min', top_k=Config['checkpoint_top_k'],
+                 keep_last=Config['checkpoint_keep_last']):
+        self.root = root
+        self.objects = os.path.join(root, 'objects')
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(os.path.join(root, 'onnx'), exist_ok=True)
+        self.monitor = monitor
+        self.mode = mode
+        self.top_k = top_k
+        self.keep_last = keep_last
+        self.index = self.read_index()
+
+    def read_index(self):
+        try:
+            with open(os.path.join(self.root, 'index.json'), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'monitor': self.monitor, 'mode': self.mode, 'checkpoints': []}
+
+    def write_index(self):
+        tmp_path = os.path.join(self.root, 'index.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(tmp_path, os.path.join(self.root, 'index.json'))
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest + '.pt')
+
+    def onnx_path(self, epoch):
+        return os.path.join(self.root, 'onnx', f'model_{epoch}.onnx')
+
+    def put_tensor(self, tensor):
+        digest = tensor_digest(tensor)
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            tmp_path = path + '.tmp'
+            torch.save(tensor.clone(), tmp_path)
+            os.replace(tmp_path, path)
+        return digest
+
+    def add(self, state, epoch, results, onnx_path=None):
+        """Stores a snapshot() taken at epoch with its validation results, then applies the retention"""
+        entry = {
+            'epoch': epoch,
+            'results': results,
+            'tensors': {key: self.put_tensor(value) for key, value in state.items()},
+            'onnx': os.path.relpath(onnx_path, self.root) if onnx_path is not None else None
+        }
+        self.index['checkpoints'] = [e for e in self.index['checkpoints'] if e['epoch'] != epoch] + [entry]
+        self.retain()
+        self.write_index()
+        self.collect_garbage()
+        return entry
+
+    def ranked(self):
+        """Checkpoints from best to worst by the monitored result"""
+        return sorted(self.index['checkpoints'], key=lambda e: e['results'][self.index['monitor']],
+                      reverse=self.index['mode'] == 'max')
+
+    def retain(self, keep=None):
+        checkpoints = self.index['checkpoints']
+        if keep is None:
+            keep = {e['epoch'] for e in self.ranked()[:self.top_k]}
+            if self.keep_last:
+                keep.update(e['epoch'] for e in sorted(checkpoints, key=lambda e: e['epoch'])[-self.keep_last:])
+        for entry in checkpoints:
+            if entry['epoch'] not in keep and entry['onnx'] is not None:
+                # the dynamo ONNX exporter writes the weights next to the graph
+                for path in [entry['onnx'], entry['onnx'] + '.data']:
+                    if os.path.exists(os.path.join(self.root, path)):
+                        os.remove(os.path.join(self.root, path))
+        self.index['checkpoints'] = [e for e in checkpoints if e['epoch'] in keep]
+
+    def collect_garbage(self):
+        referenced = {digest for e in self.index['checkpoints'] for digest in e['tensors'].values()}
+        for file in os.listdir(self.objects):
+            if file.endswith('.pt') and file[:-len('.pt')] not in referenced:
+                os.remove(os.path.join(self.objects, file))
+
+    def clear(self):
+        """Removes every checkpoint, e.g. those of an earlier run into the same model_path"""
+        self.retain(keep=set())
+        self.index = {'monitor': self.monitor, 'mode': self.mode, 'checkpoints': []}
+        self.write_index()
+        self.collect_garbage()
+
+    def find(self, epoch=None):
+        """The checkpoint of an epoch, or the best retained checkpoint when epoch is None"""
+        if epoch is None:
+            ranked = self.ranked()
+            return ranked[0] if ranked else None
+        for entry in self.index['checkpoints']:
+            if entry['epoch'] == epoch:
+                return entry
+        return None
+
+    def load(self, entry):
+        """The state_dict of an index entry"""
+        return {key: torch.load(self.object_path(digest)) for key, digest in entry['tensors'].items()}
+
+
+def onnx_axes(model):
+    """dynamic_axes of an ONNX export, the batch axis and the frame axis of models taking windows of any length"""
+    # a ScaledModel is exported with the axes of the model it wraps
+    frame_axis = getattr(getattr(model, 'model', model), 'frame_axis', None)
+    axes = {0: 'batch'} if frame_axis is None else {0: 'batch', frame_axis: 'frames'}
+    return {'input': axes, 'output': axes}
+
+
+def declared_shapes(path):
+    """Dims of the graph inputs and outputs an .onnx file declares, by tensor name, names for dynamic axes"""
+    graph = onnx.load(path, load_external_data=False).graph
+    return {value.name: [dim.dim_param or dim.dim_value for dim in value.type.tensor_type.shape.dim]
+            for value in list(graph.input) + list(graph.output)}
+
+
+def export_onnx(model, dummy_input, path):
+    """Exports model with named 'input'/'output' tensors that take any batch size
+
+    Uses the TorchScript exporter, the dynamo one specializes axes the dummy input
+    has a size of 1 in and declares them static. When onnx is installed the declared
+    dims of the written graph are checked against onnx_axes().
+    """
+    axes = onnx_axes(model)
+    torch.onnx.export(model, dummy_input, path, export_params=True, input_names=['input'], output_names=['output'],
+                      dynamic_axes=axes, dynamo=False)
+    if onnx is not None:
+        shapes = declared_shapes(path)
+        for name, names in axes.items():
+            for axis, dim in names.items():
+                if shapes[name][axis] != dim:
+                    raise ValueError(f'{path} declares axis {axis} of {name} as {shapes[name][axis]!r} instead of {dim!r}')
+
+
+class CheckpointWriter:
+    """Writes .pth and .onnx checkpoints on a background thread.
+
+    The training thread only takes a snapshot of the weights, serialization,
+    ONNX export and the file writes run on the worker. At most max_pending
+    checkpoints are queued, a further save() blocks until the worker caught up.
+    snapshot() reuses up to max_pending (pinned) buffers, a buffer goes back to
+    the pool through release() once the jobs queued with it are written.
+    Errors of the worker are raised on the next call from the training thread.
+
+    Args-
+        model- Model being trained, a CPU copy of it is used for the ONNX exports
+        store- Optional CheckpointStore the checkpoints of add() go to
+        max_pending- Maximum number of queued checkpoints
+        background- Write on a worker thread, or synchronously when False
+        export_wrapper- Optional function wrapping the model for the ONNX exports, e.g. a
+            ScaledModel with the data scaling folded in
+    """
+    def __init__(self, model, store=None, max_pending=Config['checkpoint_queue_depth'],
+                 background=Config['async_checkpoint'], export_wrapper=None):
+        self.model = model
+        self.export_model = copy.deepcopy(model).cpu().eval()
+        # the wrapper holds export_model, loading a state into export_model updates the exported graph
+        self.export_graph = export_wrapper(self.export_model).eval() if export_wrapper is not None else self.export_model
+        self.store = store
+        self.background = background
+        self.error = None
+        self.buffers = queue.Queue()
+        self.num_buffers = 0
+        self.max_buffers = max_pending
+        if background:
+            self.jobs = queue.Queue(maxsize=max_pending)
+            self.worker = threading.Thread(target=self.run, name='checkpoint-writer', daemon=True)
+            self.worker.start()
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                # buffers go back to the pool even after an error, snapshot() could wait forever otherwise
+                if self.error is None or job[0] == self.recycle:
+                    job[0](*job[1:])
+            except Exception as e:
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def export_onnx(self, state, onnx_path, dummy_input):
+        self.export_model.load_state_dict(state)
+        export_onnx(self.export_graph, dummy_input, onnx_path)
+
+    def write(self, state, pth_path, onnx_path, dummy_input):
+        if pth_path is not None:
+            torch.save(state, pth_path)
+        if onnx_path is not None:
+            self.export_onnx(state, onnx_path, dummy_input)
+
+    def write_atomic(self, state, path):
+        # a preempted write never leaves a truncated file behind
+        tmp_path = path + '.tmp'
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+
+    def write_to_store(self, state, epoch, results, dummy_input):
+        onnx_path = None
+        if dummy_input is not None:
+            onnx_path = self.store.onnx_path(epoch)
+            self.export_onnx(state, onnx_path, dummy_input)
+        self.store.add(state, epoch, results, onnx_path)
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError('Writing a checkpoint failed') from error
+
+    def submit(self, *job):
+        self.check()
+        if self.background:
+            self.jobs.put(job)
+        else:
+            job[0](*job[1:])
+
+    def snapshot(self):
+        """A snapshot() of the model in a pooled buffer, blocks while every buffer is still queued"""
+        self.check()
+        if self.buffers.empty() and self.num_buffers < self.max_buffers:
+            self.num_buffers += 1
+            return snapshot(self.model)
+        return snapshot(self.model, out=self.buffers.get())
+
+    def recycle(self, state):
+        self.buffers.put(state)
+
+    def release(self, state):
+        """Returns a snapshot() to the pool once every job queued before is written"""
+        self.submit(self.recycle, state)
+
+    def save(self, state, pth_path=None, onnx_path=None, dummy_input=None):
+        """Queues a snapshot() to be written as pth_path and/or exported to onnx_path"""
+        if dummy_input is not None:
+            dummy_input = dummy_input.detach().cpu()
+        self.submit(self.write, state, pth_path, onnx_path, dummy_input)
+
+    def add(self, state, epoch, results, dummy_input=None):
+        """Queues a snapshot() for the store, exported to ONNX as well when dummy_input is given"""
+        if dummy_input is not None:
+            dummy_input = dummy_input.detach().cpu()
+        self.submit(self.write_to_store, state, epoch, results, dummy_input)
+
+    def save_training_state(self, state, path):
+        """Queues a full training state (Trainer.training_state) to be written atomically to path"""
+        self.submit(self.write_atomic, state, path)
+
+    def flush(self):
+        """Waits until every queued checkpoint is written"""
+        if self.background:
+            self.jobs.join()
+        self.check()
+
+    def close(self):
+        if self.background:
+            self.jobs.put(None)
+            self.worker.join()
+        self.check()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Writes a checkpoint of a run as a plain .pth state_dict')
+    parser.add_argument('--model_path', default=Config['model_path'])
+    parser.add_argument('--name', default='', help='Trainer name of the run, e.g. left or right')
+    parser.add_argument('--epoch', type=int, default=None, help='defaults to the best checkpoint')
+    parser.add_argument('--out', default='model.pth')
+    args = parser.parse_args()
+
+    store = CheckpointStore(os.path.join(args.model_path, 'checkpoints', args.name))
+    entry = store.find(args.epoch)
+    if entry is None:
+        raise SystemExit('No such checkpoint')
+    torch.save(store.load(entry), args.out)
+    print(f'Epoch {entry["epoch"]} {entry["results"]} -> {args.out}')
@@ -1,294 +1,367 @@
 import torch
 import os
+import zlib
 import pandas as pd
 import numpy as np
 from sklearn.preprocessing import MinMaxScaler
 
 from utils import Config
+from cache import iter_session
+from ingest import read_sessions, list_sessions
+from features import relative_features, relative_hand_features, relative_hand_features_per_frame
+from stats import session_stats, merge_stats, scaler_from_stats, fit_scaler
+
+# The 40 recorded pose columns (.iloc[:, 1:41] of a session CSV) followed by the 9 derived relative columns
+COLUMNS = ['headPosx', 'headPosy', 'headPosz', 'headRotx', 'headRoty', 'headRotz', 'headRotQx', 'headRotQy', 'headRotQz', 'headRotQw',
+           'handRPosx', 'handRPosy', 'handRPosz', 'handRRotx', 'handRRoty', 'handRRotz', 'handRRotQx', 'handRRotQy', 'handRRotQz', 'handRRotQw',
+           'handLPosx', 'handLPosy', 'handLPosz', 'handLRotx', 'handLRoty', 'handLRotz', 'handLRotQx', 'handLRotQy', 'handLRotQz', 'handLRotQw',
+           'tracker1Posx', 'tracker1Posy', 'tracker1Posz', 'tracker1Rotx', 'tracker1Roty', 'tracker1Rotz', 'tracker1RotQx', 'tracker1RotQy', 'tracker1RotQz', 'tracker1RotQw',
+           'relativeHandRPosx', 'relativeHandRPosy', 'relativeHandRPosz', 'relativeHandLPosx', 'relativeHandLPosy', 'relativeHandLPosz',
+           'relativeTracker1Posx', 'relativeTracker1Posy', 'relativeTracker1Posz']
+
+RELATIVE_FEATURES = (
+    ['headPosy', 'headRotQx', 'headRotQy', 'headRotQz', 'headRotQw',
+     'relativeHandRPosx', 'relativeHandRPosy', 'relativeHandRPosz', 'handRRotQx', 'handRRotQy', 'handRRotQz', 'handRRotQw',
+     'relativeHandLPosx', 'relativeHandLPosy', 'relativeHandLPosz', 'handLRotQx', 'handLRotQy', 'handLRotQz', 'handLRotQw'],
+    ['relativeTracker1Posx', 'relativeTracker1Posy', 'relativeTracker1Posz',
+     'tracker1RotQx', 'tracker1RotQy', 'tracker1RotQz', 'tracker1RotQw']
+)
+
+# (input columns, label columns) returned by CSVDataset and LSTMCSVDataset for every output_type
+OUTPUT_TYPES = {
+    'euler': (
+        ['headPosx', 'headPosy', 'headPosz', 'headRotx', 'headRoty', 'headRotz',
+         'handRPosx', 'handRPosy', 'handRPosz', 'handRRotx', 'handRRoty', 'handRRotz',
+         'handLPosx', 'handLPosy', 'handLPosz', 'handLRotx', 'handLRoty', 'handLRotz'],
+        ['tracker1Posx', 'tracker1Posy', 'tracker1Posz', 'tracker1Rotx', 'tracker1Roty', 'tracker1Rotz']
+    ),
+    'quaternion': (
+        ['headPosx', 'headPosy', 'headPosz', 'headRotQx', 'headRotQy', 'headRotQz', 'headRotQw',
+         'handRPosx', 'handRPosy', 'handRPosz', 'handRRotQx', 'handRRotQy', 'handRRotQz', 'handRRotQw',
+         'handLPosx', 'handLPosy', 'handLPosz', 'handLRotQx', 'handLRotQy', 'handLRotQz', 'handLRotQw'],
+        ['tracker1Posx', 'tracker1Posy', 'tracker1Posz', 'tracker1RotQx', 'tracker1RotQy', 'tracker1RotQz', 'tracker1RotQw']
+    ),
+    'both': (
+        ['headPosx', 'headPosy', 'headPosz', 'headRotx', 'headRoty', 'headRotz', 'headRotQx', 'headRotQy', 'headRotQz', 'headRotQw',
+         'handRPosx', 'handRPosy', 'handRPosz', 'handRRotx', 'handRRoty', 'handRRotz', 'handRRotQx', 'handRRotQy', 'handRRotQz', 'handRRotQw',
+         'handLPosx', 'handLPosy', 'handLPosz', 'handLRotx', 'handLRoty', 'handLRotz', 'handLRotQx', 'handLRotQy', 'handLRotQz', 'handLRotQw'],
+        ['tracker1Posx', 'tracker1Posy', 'tracker1Posz', 'tracker1Rotx', 'tracker1Roty', 'tracker1Rotz',
+         'tracker1RotQx', 'tracker1RotQy', 'tracker1RotQz', 'tracker1RotQw']
+    ),
+    'relative': RELATIVE_FEATURES,
+    'relative_svm': RELATIVE_FEATURES,
+    'hacklstm': RELATIVE_FEATURES,
+}
+
+
+def compile_output_type(output_type):
+    """Returns the (input, label) column positions in COLUMNS for an output_type"""
+    inputs, labels = OUTPUT_TYPES[output_type]
+    return np.array([COLUMNS.index(c) for c in inputs]), np.array([COLUMNS.index(c) for c in labels])
+
+
+def collate_batch(batch):
+    # Datasets with __getitems__ already return a collated (inputs, labels) batch
+    return batch
+
+
+def materialize(dataset, chunk_size=65536):
+    """Gathers every (inputs, labels) sample of a map-style dataset into two stacked tensors"""
+    all_inputs = []
+    all_labels = []
+    getitems = getattr(dataset, '__getitems__', None)
+    for start in range(0, len(dataset), chunk_size):
+        indices = list(range(start, min(start + chunk_size, len(dataset))))
+        batch = getitems(indices) if callable(getitems) else [dataset[idx] for idx in indices]
+        # a Subset of a dataset without __getitems__ returns the samples uncollated
+        if isinstance(batch, list):
+            batch = torch.utils.data.default_collate(batch)
+        all_inputs.append(batch[0])
+        all_labels.append(batch[1])
+    return torch.cat(all_inputs), torch.cat(all_labels)
+
+
+class DeviceBatchLoader:
+    """In-memory replacement of DataLoader for datasets that fit on the training device.
+
+    Every sample is gathered once into contiguous input and label tensors on
+    device. Each epoch then slices batches out of a random permutation, with no
+    worker processes, per-sample __getitem__ calls or host to device copies.
+
+    Args-
+        dataset- Map-style dataset (or Subset) returning (inputs, labels) samples
+        batch_size- Samples per batch, the last batch may be smaller
+        shuffle- Draw a new permutation of the samples every epoch
+        device- Device the tensors are kept on
+    """
+    def __init__(self, dataset, batch_size=Config['batch_size'], shuffle=False, device='cpu'):
+        inputs, labels = materialize(dataset)
+        self.inputs = inputs.contiguous().to(device)
+        self.labels = labels.contiguous().to(device)
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return (len(self.inputs) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        num_samples = len(self.inputs)
+        if not self.shuffle:
+            for start in range(0, num_samples, self.batch_size):
+                yield self.inputs[start:start+self.batch_size], self.labels[start:start+self.batch_size]
+            return
+        order = torch.randperm(num_samples, device=self.inputs.device)
+        for start in range(0, num_samples, self.batch_size):
+            idx = order[start:start+self.batch_size]
+            yield self.inputs[idx], self.labels[idx]
+
+
+def make_loader(dataset, shuffle, device, collate_fn=None):
+    """DeviceBatchLoader when Config['device_loader'] is set, a DataLoader with Config['num_workers'] otherwise"""
+    if Config['device_loader'] and not isinstance(dataset, torch.utils.data.IterableDataset):
+        return DeviceBatchLoader(dataset, Config['batch_size'], shuffle=shuffle, device=device)
+    return torch.utils.data.DataLoader(
+        dataset,
+        batch_size=Config['batch_size'],
+        shuffle=shuffle,
+        num_workers=Config['num_workers'],
+        collate_fn=collate_fn,
+        # lets the Trainer copy batches to the GPU with non_blocking=True
+        pin_memory=torch.device(device).type == 'cuda'
+    )
+
+
+def split_dataset(dataset, ratio, resume=None):
+    """Random train/valid split, or the split of a resumed run
+
+    Args-
+        dataset- Map-style dataset to split
+        ratio- Fraction of the samples that go to the train split
+        resume- Optional training state from load_training_state(), its split indices are reused
+
+    Returns-
+        The train and valid Subsets
+    """
+    if resume is not None and 'train' in resume['splits'] and 'valid' in resume['splits']:
+        return (torch.utils.data.Subset(dataset, resume['splits']['train']),
+                torch.utils.data.Subset(dataset, resume['splits']['valid']))
+    lengths = [int(len(dataset) * ratio), len(dataset) - int(len(dataset) * ratio)]
+    return torch.utils.data.random_split(dataset, lengths)
 
 class LSTMCSVDataset(torch.utils.data.Dataset):
     def __init__(self, root_path, output_type=Config['data_type'], look_back=10, step_value = 1):
-        files = os.listdir(root_path)
-        files = [f for f in files if f.endswith('.csv')]
         all_data=[]
-
-        for file in files:
-            csv_data = pd.read_csv(os.path.join(root_path,file)).iloc[:,1:41]
-
-            csv_data['relativeHandRPosx'] = csv_data.headPosx-csv_data.handRPosx
-            csv_data['relativeHandRPosy'] = csv_data['headPosy']-csv_data['handRPosy']
-            csv_data['relativeHandRPosz'] = csv_data['headPosz']-csv_data['handRPosz']
-            csv_data['relativeHandLPosx'] = csv_data['headPosx']-csv_data['handLPosx']
-            csv_data['relativeHandLPosy'] = csv_data['headPosy']-csv_data['handLPosy']
-            csv_data['relativeHandLPosz'] = csv_data['headPosz']-csv_data['handLPosz']
-            csv_data['relativeTracker1Posx'] = csv_data['headPosx']-csv_data['tracker1Posx']
-            csv_data['relativeTracker1Posy'] = csv_data['headPosy']-csv_data['tracker1Posy']
-            csv_data['relativeTracker1Posz'] = csv_data['headPosz']-csv_data['tracker1Posz']
-
-            data = np.array([csv_data])
-            all_data.append(data)
-        self.data = np.concatenate(all_data, axis=1).squeeze(0)
-        self.scaler = MinMaxScaler(feature_range=(-1,1))
-        self.scaler.fit(self.data)
-        self.scaled_data = self.scaler.transform(self.data)
-        self.lstm_data = []
-        for i in range(len(self.scaled_data)-look_back-1):
-            a = self.scaled_data[i:(i+look_back):step_value]
-            self.lstm_data.append(a)
-        self.lstm_data = np.array(self.lstm_data)
+        all_stats=[]
+
+        for file, csv_data in read_sessions(root_path, columns=slice(1,41), prepare=relative_features, required=COLUMNS[:40]):
+            all_stats.append(session_stats(os.path.join(root_path, file), csv_data))
+            all_data.append(csv_data.to_numpy(dtype=np.float32))
+        self.scaler = scaler_from_stats(merge_stats(all_stats), feature_range=(-1,1))
+        lengths = [len(data) for data in all_data]
+        # Single float32 copy of every frame, scaled in place (same as self.scaler.transform)
+        self.scaled_data = np.concatenate(all_data, axis=0)
+        del all_data
+        self.scaled_data *= self.scaler.scale_
+        self.scaled_data += self.scaler.min_
+        self.index_windows(lengths, output_type, look_back, step_value)
+
+    @classmethod
+    def from_frames(cls, scaled_data, session_lengths, output_type=Config['data_type'], look_back=10, step_value=1, scaler=None):
+        """Windows over frames that are already scaled, e.g. the shared memory copy of a sweep (see sweep.py)
+
+        Args-
+            scaled_data- (frames, len(COLUMNS)) float32 array of every session one after another
+            session_lengths- Number of frames of every session in scaled_data
+            scaler- Optional scaler the frames were scaled with
+        """
+        dataset = cls.__new__(cls)
+        dataset.scaler = scaler
+        dataset.scaled_data = scaled_data
+        dataset.index_windows(session_lengths, output_type, look_back, step_value)
+        return dataset
+
+    def index_windows(self, lengths, output_type, look_back, step_value):
+        # Start frame of every window, per file so that no window spans two sessions
+        starts = []
+        offset = 0
+        for length in lengths:
+            starts.append(np.arange(offset, offset + max(length - look_back - 1, 0)))
+            offset += length
+        self.window_starts = np.concatenate(starts)
+        self.frame_offsets = np.arange(0, look_back, step_value)
         self.output_type = output_type
+        self.input_idx, self.label_idx = compile_output_type(output_type)
         self.look_back = look_back
         self.step_value = step_value
+
     def __len__(self):
-        return self.lstm_data.shape[0]
+        return len(self.window_starts)
 
     def __getitem__(self, idx):
-        row = self.lstm_data[idx]
-        headPosx = row[:, 0]
-        headPosy = row[:,1]
-        headPosz = row[:,2]
-        headRotx = row[:,3]
-        headRoty = row[:,4]
-        headRotz = row[:,5]
-        headRotQx = row[:,6]
-        headRotQy = row[:,7]
-        headRotQz = row[:,8]
-        headRotQw = row[:,9]
-
-        handRPosx = row[:,10]
-        handRPosy = row[:,11]
-        handRPosz = row[:,12]
-        handRRotx = row[:,13]
-        handRRoty = row[:,14]
-        handRRotz = row[:,15]
-        handRRotQx = row[:,16]
-        handRRotQy = row[:,17]
-        handRRotQz = row[:,18]
-        handRRotQw = row[:,19]
-
-        handLPosx = row[:,20]
-        handLPosy = row[:,21]
-        handLPosz = row[:,22]
-        handLRotx = row[:,23]
-        handLRoty = row[:,24]
-        handLRotz = row[:,25]
-        handLRotQx = row[:,26]
-        handLRotQy = row[:,27]
-        handLRotQz = row[:,28]
-        handLRotQw = row[:,29]
-
-        tracker1Posx = row[:,30]
-        tracker1Posy = row[:,31]
-        tracker1Posz = row[:,32]
-        tracker1Rotx = row[:,33]
-        tracker1Roty = row[:,34]
-        tracker1Rotz = row[:,35]
-        tracker1RotQx = row[:,36]
-        tracker1RotQy = row[:,37]
-        tracker1RotQz = row[:,38]
-        tracker1RotQw = row[:,39]
-
-        relativeHandRPosx = row[:,40]
-        relativeHandRPosy = row[:,41]
-        relativeHandRPosz = row[:,42]
-        relativeHandLPosx = row[:,43]
-        relativeHandLPosy = row[:,44]
-        relativeHandLPosz = row[:,45]
-        relativeTracker1Posx = row[:,46]
-        relativeTracker1Posy = row[:,47]
-        relativeTracker1Posz = row[:,48]
-
-        if self.output_type=='euler':
-            return (
-                torch.FloatTensor(np.stack([headPosx, headPosy, headPosz, headRotx, headRoty, headRotz,
-                    handRPosx, handRPosy, handRPosz, handRRotx, handRRoty, handRRotz,
-                    handLPosx, handLPosy, handLPosz, handLRotx, handLRoty, handLRotz,
-                    ],axis=-1)),
-                torch.FloatTensor(np.stack([tracker1Posx, tracker1Posy, tracker1Posz, tracker1Rotx, tracker1Roty,
-                    tracker1Rotz],axis=-1))
-            )
-        elif self.output_type=='quaternion':
-            return (
-                torch.FloatTensor(np.stack([headPosx, headPosy, headPosz, headRotQx, headRotQy, headRotQz, headRotQw,
-                    handRPosx, handRPosy, handRPosz, handRRotQx, handRRotQy, handRRotQz, handRRotQw,
-                    handLPosx, handLPosy, handLPosz, handLRotQx, handLRotQy, handLRotQz, handLRotQw,
-                    ],axis=-1)),
-                torch.FloatTensor(np.stack([tracker1Posx, tracker1Posy, tracker1Posz, tracker1RotQx, tracker1RotQy,
-                    tracker1RotQz, tracker1RotQw],axis=-1))
-            )
-        elif self.output_type=='both':
-            return (
-                torch.FloatTensor(np.stack([headPosx, headPosy, headPosz, headRotx, headRoty, headRotz,headRotQx, headRotQy, headRotQz, headRotQw,
-                    handRPosx, handRPosy, handRPosz, handRRotx, handRRoty, handRRotz, handRRotQx, handRRotQy, handRRotQz, handRRotQw,
-                    handLPosx, handLPosy, handLPosz, handLRotx, handLRoty, handLRotz, handLRotQx, handLRotQy, handLRotQz, handLRotQw
-                    ],axis=-1)),
-                torch.FloatTensor(np.stack([tracker1Posx, tracker1Posy, tracker1Posz, tracker1Rotx, tracker1Roty,
-                    tracker1Rotz, tracker1RotQx, tracker1RotQy, tracker1RotQz, tracker1RotQw],axis=-1))
-            )
-        elif self.output_type=='relative' or self.output_type=='relative_svm' or self.output_type=='hacklstm':
-            return (
-                torch.FloatTensor(np.stack([headPosy, headRotQx, headRotQy, headRotQz, headRotQw,
-                    relativeHandRPosx, relativeHandRPosy, relativeHandRPosz, handRRotQx, handRRotQy, handRRotQz, handRRotQw,
-                    relativeHandLPosx, relativeHandLPosy, relativeHandLPosz, handLRotQx, handLRotQy, handLRotQz, handLRotQw
-                    ],axis=-1)),
-                torch.FloatTensor(np.stack([relativeTracker1Posx, relativeTracker1Posy, relativeTracker1Posz,
-                    tracker1RotQx, tracker1RotQy, tracker1RotQz, tracker1RotQw],axis=-1))
-            )
+        start = self.window_starts[idx]
+        row = self.scaled_data[start:start+self.look_back:self.step_value]
+        return torch.from_numpy(row[:, self.input_idx]), torch.from_numpy(row[:, self.label_idx])
+
+    def __getitems__(self, indices):
+        # (batch, look_back/step_value) frame indices gathered with one fancy index per tensor
+        frames = self.window_starts[indices][:, None] + self.frame_offsets[None, :]
+        return (
+            torch.from_numpy(self.scaled_data[frames[:, :, None], self.input_idx]),
+            torch.from_numpy(self.scaled_data[frames[:, :, None], self.label_idx])
+        )
 
 class CSVDataset(torch.utils.data.Dataset):
     def __init__(self, root_path, output_type=Config['data_type']):
-        files = os.listdir(root_path)
-        files = [f for f in files if f.endswith('.csv')]
         all_data=[]
+        all_stats=[]
+        self.session_lengths = []
        
-        for file in files:
+        for file, csv_data in read_sessions(root_path, columns=slice(1,41), prepare=relative_features, required=COLUMNS[:40]):
             print(file)
-            csv_data = pd.read_csv(os.path.join(root_path,file)).iloc[:,1:41]
-            
-            csv_data['relativeHandRPosx'] = csv_data.headPosx-csv_data.handRPosx
-            csv_data['relativeHandRPosy'] = csv_data['headPosy']-csv_data['handRPosy']
-            csv_data['relativeHandRPosz'] = csv_data['headPosz']-csv_data['handRPosz']
-            csv_data['relativeHandLPosx'] = csv_data['headPosx']-csv_data['handLPosx']
-            csv_data['relativeHandLPosy'] = csv_data['headPosy']-csv_data['handLPosy']
-            csv_data['relativeHandLPosz'] = csv_data['headPosz']-csv_data['handLPosz']
-            csv_data['relativeTracker1Posx'] = csv_data['headPosx']-csv_data['tracker1Posx']
-            csv_data['relativeTracker1Posy'] = csv_data['headPosy']-csv_data['tracker1Posy']
-            csv_data['relativeTracker1Posz'] = csv_data['headPosz']-csv_data['tracker1Posz']
-            csv_data.to_csv('relative_columns.csv', index=False)
+            all_stats.append(session_stats(os.path.join(root_path, file), csv_data))
             data = np.array([csv_data])
             all_data.append(data)
+            self.session_lengths.append(len(csv_data))
         self.data = np.concatenate(all_data, axis=1).squeeze(0)
-        self.scaler = MinMaxScaler(feature_range=(0,1))
-        self.scaler.fit(self.data)
-        self.scaled_data = self.scaler.transform(self.data)
+        self.stats = merge_stats(all_stats)
+        self.scaler = scaler_from_stats(self.stats, feature_range=(0,1))
+        self.scaled_data = self.scaler.transform(self.data).astype(np.float32)
         print(self.scaled_data.shape)
 
         self.output_type = output_type
+        self.input_idx, self.label_idx = compile_output_type(output_type)
+
+    @classmethod
+    def from_frames(cls, scaled_data, output_type=Config['data_type'], scaler=None):
+        """CSVDataset over frames that are already scaled, e.g. the shared memory copy of a sweep (see sweep.py)"""
+        dataset = cls.__new__(cls)
+        dataset.scaler = scaler
+        dataset.scaled_data = scaled_data
+        dataset.output_type = output_type
+        dataset.input_idx, dataset.label_idx = compile_output_type(output_type)
+        return dataset
     
     def __len__(self):
-        return len(self.data)
+        return len(self.scaled_data)
     
     def __getitem__(self, idx):
-        keys = ['headPosx', 'headPosy', 'headPosz', 'headRotx', 'headRoty', 'headRotz', 'headRotQx', 'headRotQy', 'headRotQz', 'headRotQw', 'handRPosx', 'handRPosy', 'handRPosz', 'handRRotx', 'handRRoty', 'handRRotz', 'handRRotQx', 'handRRotQy', 'handRRotQz', 'handRRotQw', 'handLPosx', 'handLPosy', 'handLPosz', 'handLRotx', 'handLRoty', 'handLRotz', 'handLRotQx', 'handLRotQy', 'handLRotQz', 'handLRotQw', 'tracker1Posx', 'tracker1Posy', 'tracker1Posz', 'tracker1Rotx', 'tracker1Roty', 'tracker1Rotz', 'tracker1RotQx', 'tracker1RotQy', 'tracker1RotQz', 'tracker1RotQw', 'relativeHandRPosx', 'relativeHandRPosy', 'relativeHandRPosz', 'relativeHandLPosx', 'relativeHandLPosy', 'relativeHandLPosz', 'relativeTracker1Posx', 'relativeTracker1Posy', 'relativeTracker1Posz']
         row = self.scaled_data[idx]
-        # print(row)
-        # print(keys.index('headPosx'))
-        headPosx = row[keys.index('headPosx')]
-        headPosy = row[keys.index('headPosy')]
-        headPosz = row[keys.index('headPosz')]
-        headRotx = row[keys.index('headRotx')]
-        headRoty = row[keys.index('headRoty')]
-        headRotz = row[keys.index('headRotz')]
-        headRotQx = row[keys.index('headRotQx')]
-        headRotQy = row[keys.index('headRotQy')]
-        headRotQz = row[keys.index('headRotQz')]
-        headRotQw = row[keys.index('headRotQw')]
-
-        handRPosx = row[keys.index('handRPosx')]
-        handRPosy = row[keys.index('handRPosy')]
-        handRPosz = row[keys.index('handRPosz')]
-        handRRotx = row[keys.index('handRRotx')]
-        handRRoty = row[keys.index('handRRoty')]
-        handRRotz = row[keys.index('handRRotz')]
-        handRRotQx = row[keys.index('handRRotQx')]
-        handRRotQy = row[keys.index('handRRotQy')]
-        handRRotQz = row[keys.index('handRRotQz')]
-        handRRotQw = row[keys.index('handRRotQw')]
-
-        handLPosx = row[keys.index('handLPosx')]
-        handLPosy = row[keys.index('handLPosy')]
-        handLPosz = row[keys.index('handLPosz')]
-        handLRotx = row[keys.index('handLRotx')]
-        handLRoty = row[keys.index('handLRoty')]
-        handLRotz = row[keys.index('handLRotz')]
-        handLRotQx = row[keys.index('handLRotQx')]
-        handLRotQy = row[keys.index('handLRotQy')]
-        handLRotQz = row[keys.index('handLRotQz')]
-        handLRotQw = row[keys.index('handLRotQw')]
-
-        tracker1Posx = row[keys.index('tracker1Posx')]
-        tracker1Posy = row[keys.index('tracker1Posy')]
-        tracker1Posz = row[keys.index('tracker1Posz')]
-        tracker1Rotx = row[keys.index('tracker1Rotx')]
-        tracker1Roty = row[keys.index('tracker1Roty')]
-        tracker1Rotz = row[keys.index('tracker1Rotz')]
-        tracker1RotQx = row[keys.index('tracker1RotQx')]
-        tracker1RotQy = row[keys.index('tracker1RotQy')]
-        tracker1RotQz = row[keys.index('tracker1RotQz')]
-        tracker1RotQw = row[keys.index('tracker1RotQw')]
-
-        relativeHandRPosx = row[keys.index('relativeHandRPosx')]
-        relativeHandRPosy = row[keys.index('relativeHandRPosy')]
-        relativeHandRPosz = row[keys.index('relativeHandRPosz')]
-        relativeHandLPosx = row[keys.index('relativeHandLPosx')]
-        relativeHandLPosy = row[keys.index('relativeHandLPosy')]
-        relativeHandLPosz = row[keys.index('relativeHandLPosz')]
-        relativeTracker1Posx = row[keys.index('relativeTracker1Posx')]
-        relativeTracker1Posy = row[keys.index('relativeTracker1Posy')]
-        relativeTracker1Posz = row[keys.index('relativeTracker1Posz')]
-
-
-        if self.output_type=='euler':
-            return (
-                torch.FloatTensor([headPosx, headPosy, headPosz, headRotx, headRoty, headRotz,
-                    handRPosx, handRPosy, handRPosz, handRRotx, handRRoty, handRRotz,
-                    handLPosx, handLPosy, handLPosz, handLRotx, handLRoty, handLRotz,
-                    ]),
-                torch.FloatTensor([tracker1Posx, tracker1Posy, tracker1Posz, tracker1Rotx, tracker1Roty, 
-                    tracker1Rotz])
-            )
-        elif self.output_type=='quaternion':
-            return (
-                torch.FloatTensor([headPosx, headPosy, headPosz, headRotQx, headRotQy, headRotQz, headRotQw,
-                    handRPosx, handRPosy, handRPosz, handRRotQx, handRRotQy, handRRotQz, handRRotQw,
-                    handLPosx, handLPosy, handLPosz, handLRotQx, handLRotQy, handLRotQz, handLRotQw,
-                    ]),
-                torch.FloatTensor([tracker1Posx, tracker1Posy, tracker1Posz, tracker1RotQx, tracker1RotQy, 
-                    tracker1RotQz, tracker1RotQw])
-            )
-        elif self.output_type=='both':
-            return (
-                torch.FloatTensor([headPosx, headPosy, headPosz, headRotx, headRoty, headRotz,headRotQx, headRotQy, headRotQz, headRotQw,
-                    handRPosx, handRPosy, handRPosz, handRRotx, handRRoty, handRRotz, handRRotQx, handRRotQy, handRRotQz, handRRotQw,
-                    handLPosx, handLPosy, handLPosz, handLRotx, handLRoty, handLRotz, handLRotQx, handLRotQy, handLRotQz, handLRotQw
-                    ]),
-                torch.FloatTensor([tracker1Posx, tracker1Posy, tracker1Posz, tracker1Rotx, tracker1Roty, 
-                    tracker1Rotz, tracker1RotQx, tracker1RotQy, tracker1RotQz, tracker1RotQw])
-            )
-        elif self.output_type=='relative' or self.output_type=='relative_svm':
-            # return (
-            #     torch.FloatTensor([headPosy, headRotx, headRoty, headRotz,
-            #         relativeHandRPosx, relativeHandRPosy, relativeHandRPosz, handRRotx, handRRoty, handRRotz,
-            #         relativeHandLPosx, relativeHandLPosy, relativeHandLPosz, handLRotx, handLRoty, handLRotz,
-            #         ]),
-            #     torch.FloatTensor([relativeTracker1Posx, relativeTracker1Posy, relativeTracker1Posz,
-            #         tracker1Rotx, tracker1Roty, tracker1Rotz])
-            # )
-            return (
-                torch.FloatTensor(np.stack([headPosy, headRotQx, headRotQy, headRotQz, headRotQw,
-                    relativeHandRPosx, relativeHandRPosy, relativeHandRPosz, handRRotQx, handRRotQy, handRRotQz, handRRotQw,
-                    relativeHandLPosx, relativeHandLPosy, relativeHandLPosz, handLRotQx, handLRotQy, handLRotQz, handLRotQw
-                    ],axis=-1)),
-                torch.FloatTensor(np.stack([relativeTracker1Posx, relativeTracker1Posy, relativeTracker1Posz, #],axis=-1))
-                    tracker1RotQx, tracker1RotQy, tracker1RotQz, tracker1RotQw],axis=-1))
-            )
+        return torch.from_numpy(row[self.input_idx]), torch.from_numpy(row[self.label_idx])
+
+    def __getitems__(self, indices):
+        indices = np.asarray(indices)
+        return (
+            torch.from_numpy(self.scaled_data[np.ix_(indices, self.input_idx)]),
+            torch.from_numpy(self.scaled_data[np.ix_(indices, self.label_idx)])
+        )
+
+class StreamingCSVDataset(torch.utils.data.IterableDataset):
+    """Out-of-core version of CSVDataset (look_back=None) and LSTMCSVDataset (look_back set).
+
+    The scaler is fitted from the per-session stats sidecars, only sessions without
+    up to date stats are read (chunk by chunk) before training starts.
+    Iterating then streams the sessions again, chunk by chunk, and yields scaled
+    (inputs, labels) samples through a shuffle buffer. With DataLoader workers every
+    worker streams its own share of the files, so memory stays bounded by
+    chunk_rows and shuffle_buffer regardless of the size of the recordings.
+    """
+    def __init__(self, root_path, output_type=Config['data_type'], look_back=None, step_value=1,
+                 feature_range=(0, 1), chunk_rows=Config['stream_chunk_rows'],
+                 shuffle_buffer=Config['stream_shuffle_buffer'], scaler=None, subset=None,
+                 split_block_rows=Config['stream_split_block_rows']):
+        self.files = [os.path.join(root_path, f) for f in list_sessions(root_path)]
+        self.output_type = output_type
+        self.input_idx, self.label_idx = compile_output_type(output_type)
+        self.look_back = look_back
+        self.step_value = step_value
+        self.chunk_rows = chunk_rows
+        self.shuffle_buffer = shuffle_buffer
+        # (ratio, train) keeps the pseudo-random ratio of split_block_rows blocks (train=True) or the rest of them
+        self.subset = subset
+        self.split_block_rows = split_block_rows
+        self.root_path = root_path
+        if scaler is None:
+            scaler = fit_scaler(self.files, feature_range=feature_range)
+        self.scaler = scaler
+
+    def split(self, ratio):
+        """Splits into (train, valid) datasets sharing this scaler, the valid one is not shuffled"""
+        kwargs = dict(output_type=self.output_type, look_back=self.look_back, step_value=self.step_value,
+                      chunk_rows=self.chunk_rows, scaler=self.scaler, split_block_rows=self.split_block_rows)
+        return (
+            StreamingCSVDataset(self.root_path, shuffle_buffer=self.shuffle_buffer, subset=(ratio, True), **kwargs),
+            StreamingCSVDataset(self.root_path, shuffle_buffer=0, subset=(ratio, False), **kwargs)
+        )
+
+    def read_chunks(self, path):
+        for csv_data in iter_session(path, columns=slice(1,41), chunk_rows=self.chunk_rows):
+            # derived in float64 as CSVDataset, samples() only stores the scaled frames as float32
+            yield relative_features.transform(csv_data.to_numpy(dtype=np.float64), csv_data.columns)
+
+    def samples(self, path):
+        """Yields (frame index, inputs, labels) batches of one session, one chunk at a time"""
+        tail = np.empty((0, len(COLUMNS)), dtype=np.float32)
+        offset = 0
+        for chunk in self.read_chunks(path):
+            chunk = (chunk * self.scaler.scale_ + self.scaler.min_).astype(np.float32)
+            if self.look_back is None:
+                yield np.arange(offset, offset + len(chunk)), chunk[:, self.input_idx], chunk[:, self.label_idx]
+            else:
+                # as LSTMCSVDataset a session has len - look_back - 1 windows, the last look_back+1 frames
+                # are carried over so that windows continue across chunks
+                frames = np.concatenate([tail, chunk])
+                starts = np.arange(max(len(frames) - self.look_back - 1, 0))
+                if len(starts):
+                    window_frames = starts[:, None] + np.arange(0, self.look_back, self.step_value)[None, :]
+                    yield (offset - len(tail) + starts,
+                           frames[window_frames[:, :, None], self.input_idx],
+                           frames[window_frames[:, :, None], self.label_idx])
+                tail = frames[len(starts):]
+            offset += len(chunk)
+
+    def in_subset(self, path, frame_idx):
+        ratio, train = self.subset
+        # Whole blocks of a session go to one subset, so overlapping windows only straddle train and valid
+        # at block borders. Blocks are hashed with the session name (crc32, stable across processes and
+        # passes) so that every session splits at different offsets.
+        blocks = frame_idx // self.split_block_rows
+        session = os.path.basename(path)
+        keep = {block: zlib.crc32(f'{session}:{block}'.encode()) < ratio * 2**32 for block in np.unique(blocks).tolist()}
+        keep = np.array([keep[block] for block in blocks.tolist()], dtype=bool)
+        return keep if train else ~keep
+
+    def __iter__(self):
+        worker = torch.utils.data.get_worker_info()
+        files = self.files if worker is None else self.files[worker.id::worker.num_workers]
+        # drawn from torch so that every worker and every epoch shuffles differently
+        rng = np.random.default_rng(int(torch.randint(2**62, (1,)).item()))
+        buffer = []
+        for path in files:
+            for frame_idx, inputs, labels in self.samples(path):
+                if self.subset is not None:
+                    keep = self.in_subset(path, frame_idx)
+                    inputs, labels = inputs[keep], labels[keep]
+                for sample in zip(torch.from_numpy(inputs), torch.from_numpy(labels)):
+                    if self.shuffle_buffer == 0:
+                        yield sample
+                        continue
+                    # cloned so that buffered samples don't keep their whole chunk alive
+                    sample = (sample[0].clone(), sample[1].clone())
+                    if len(buffer) < self.shuffle_buffer:
+                        buffer.append(sample)
+                        continue
+                    idx = rng.integers(len(buffer))
+                    yield buffer[idx]
+                    buffer[idx] = sample
+        rng.shuffle(buffer)
+        yield from buffer
 
 class GestureCSVDataset(torch.utils.data.Dataset):
     def __init__(self, root_path, output_type=Config['data_type']):
-        files = os.listdir(root_path)
-        files = [f for f in files if f.endswith('.csv')]
         all_data = []
 
-        for file in files:
-            csv_data = pd.read_csv(os.path.join(root_path, file))
-            for i in range(0, 10):
-                i = str(i)
-                csv_data['relativeHandRPosx' + i] = csv_data['headPosx' + i] - csv_data['handRPosx' + i]
-                csv_data['relativeHandRPosy' + i] = csv_data['headPosy' + i] - csv_data['handRPosy' + i]
-                csv_data['relativeHandRPosz' + i] = csv_data['headPosz' + i] - csv_data['handRPosz' + i]
-                csv_data['relativeHandLPosx' + i] = csv_data['headPosx' + i] - csv_data['handLPosx' + i]
-                csv_data['relativeHandLPosy' + i] = csv_data['headPosy' + i] - csv_data['handLPosy' + i]
-                csv_data['relativeHandLPosz' + i] = csv_data['headPosz' + i] - csv_data['handLPosz' + i]
+        for file, csv_data in read_sessions(root_path, prepare=relative_hand_features_per_frame):
             all_data.append(csv_data)
         # Concatenate all data
         self.data = pd.concat(all_data, axis=0, ignore_index=True)
@@ -343,10 +416,31 @@ class GestureCSVDataset(torch.utils.data.Dataset):
                 torch.tensor(label, dtype=torch.int64)
             )
 
+def near_gesture(idx, gestures_idx, thresh=10):
+    """Vectorized check of abs(idx - jdx) < thresh for any jdx in gestures_idx, O(len(idx) * log(len(gestures_idx)))"""
+    idx = np.asarray(idx)
+    if len(gestures_idx) == 0:
+        return np.zeros(idx.shape, dtype=bool)
+    gestures_idx = np.sort(gestures_idx)
+    # The nearest gesture is either the first one at or after idx or the last one before it
+    pos = np.searchsorted(gestures_idx, idx)
+    after = gestures_idx[np.minimum(pos, len(gestures_idx) - 1)]
+    before = gestures_idx[np.maximum(pos - 1, 0)]
+    return (np.abs(after - idx) < thresh) | (np.abs(idx - before) < thresh)
+
+
+def proximal_gesture_labels(num_windows, gestures_idx_by_class, thresh=10):
+    """Labels every window start with the first class (1-based) that has a gesture within thresh frames, 0 for none"""
+    windows = np.arange(num_windows)
+    labels = np.zeros(num_windows, dtype=np.int64)
+    # Lowest priority first so that higher priority classes overwrite it
+    for label in range(len(gestures_idx_by_class), 0, -1):
+        labels[near_gesture(windows, gestures_idx_by_class[label - 1], thresh)] = label
+    return labels
+
+
 class GestureCSVDatasetv2(torch.utils.data.Dataset):
     def __init__(self, root_path, output_type='quaternion', look_back=10, step_value=1):
-        files = os.listdir(root_path)
-        files = [f for f in files if f.endswith('.csv')]
         self.stats = {
             'up': 0,
             'down': 0,
@@ -355,8 +449,7 @@ class GestureCSVDatasetv2(torch.utils.data.Dataset):
             'none': 0
         }
         gestures = []
-        for file in files:
-            csv_data = pd.read_csv(os.path.join(root_path, file))
+        for file, csv_data in read_sessions(root_path, prepare=relative_hand_features):
             up_gestures_idx = csv_data[csv_data['gesture'].isin(['Up','Up0'])].index.to_numpy()
             down_gestures_idx = csv_data[csv_data['gesture'].isin(['Down','Down0'])].index.to_numpy()
             forward_gestures_idx = csv_data[csv_data['gesture'].isin(['Forward','Forward0'])].index.to_numpy()
@@ -365,15 +458,6 @@ class GestureCSVDatasetv2(torch.utils.data.Dataset):
                 [up_gestures_idx, down_gestures_idx, forward_gestures_idx, backward_gestures_idx])
             #             print(gestures_idx.shape)
 
-            csv_data['relativeHandRPosx'] = csv_data['headPosx'] - csv_data['handRPosx']
-            csv_data['relativeHandRPosy'] = csv_data['headPosy'] - csv_data['handRPosy']
-            csv_data['relativeHandRPosz'] = csv_data['headPosz'] - csv_data['handRPosz']
-            csv_data['relativeHandLPosx'] = csv_data['headPosx'] - csv_data['handLPosx']
-            csv_data['relativeHandLPosy'] = csv_data['headPosy'] - csv_data['handLPosy']
-            csv_data['relativeHandLPosz'] = csv_data['headPosz'] - csv_data['handLPosz']
-            #             csv_data['relativeTracker1Posx'] = csv_data['headPosx']-csv_data['tracker1Posx']
-            #             csv_data['relativeTracker1Posy'] = csv_data['headPosy']-csv_data['tracker1Posy']
-            #             csv_data['relativeTracker1Posz'] = csv_data['headPosz']-csv_data['tracker1Posz']
             fields = set(csv_data.keys())
             needed_feats = []
             if output_type == 'quaternion':
@@ -391,26 +475,14 @@ class GestureCSVDatasetv2(torch.utils.data.Dataset):
             scaler = MinMaxScaler(feature_range=(-1, 1))
             scaler.fit(data)
             scaled_data = scaler.transform(data)
-            # lstm_data = []
-            print()
-            for i in range(len(scaled_data) - look_back - 1):
-                a = scaled_data[i:(i + look_back):step_value]
-                if self.check_proximal_gesture_type(i, up_gestures_idx):
-                    gestures.append((a, 1))
-                    self.stats['up'] += 1
-                elif self.check_proximal_gesture_type(i, down_gestures_idx):
-                    gestures.append((a, 2))
-                    self.stats['down'] += 1
-                elif self.check_proximal_gesture_type(i, forward_gestures_idx):
-                    gestures.append((a, 3))
-                    self.stats['forward'] += 1
-                elif self.check_proximal_gesture_type(i, backward_gestures_idx):
-                    gestures.append((a, 4))
-                    self.stats['backward'] += 1
-                else:
-                    gestures.append((a, 0))
-                    self.stats['none'] += 1
-                # lstm_data.append(a)
+            labels = proximal_gesture_labels(
+                max(len(scaled_data) - look_back - 1, 0),
+                [up_gestures_idx, down_gestures_idx, forward_gestures_idx, backward_gestures_idx])
+            counts = np.bincount(labels, minlength=5)
+            for label, key in enumerate(['none', 'up', 'down', 'forward', 'backward']):
+                self.stats[key] += int(counts[label])
+            gestures.extend((scaled_data[i:(i + look_back):step_value], label)
+                            for i, label in enumerate(labels.tolist()))
         self.gestures = gestures
 
     def __len__(self):
@@ -422,46 +494,37 @@ class GestureCSVDatasetv2(torch.utils.data.Dataset):
         return torch.FloatTensor(sequence), torch.ones(1)*label
 
     def check_proximal_gesture_type(self, idx, gestures_idx, thresh=10):
-        for jdx in gestures_idx:
-            if abs(idx - jdx) < thresh:
-                return True
-        return False
+        return bool(near_gesture(np.array([idx]), gestures_idx, thresh)[0])
+
+def grab_segments(gestures, rows_per_grab=0):
+    """Finds the rows of every grab segment in a session.
+
+    A segment is a row whose gesture is not "None" (the end of a grab) plus the
+    rows_per_grab rows recorded before it, clipped at the start of the session.
+
+    Returns-
+        rows- Row positions of all segments, in order
+        grabs- Row position of the grab each of those rows belongs to
+    """
+    grab_idx = np.flatnonzero(gestures != "None")
+    rows = (grab_idx[:, None] + np.arange(-rows_per_grab, 1)[None, :]).ravel()
+    grabs = np.repeat(grab_idx, rows_per_grab + 1)
+    in_session = rows >= 0
+    return rows[in_session], grabs[in_session]
+
 
 class GrabCSVDataset(torch.utils.data.Dataset):
-    def __init__(self, root_path, output_type=Config['data_type']):
-        files = os.listdir(root_path)
-        files = [f for f in files if f.endswith('.csv')]
+    def __init__(self, root_path, output_type=Config['data_type'], rows_per_grab=Config['rows_per_grab']):
         all_data = []
 
-
-        for file in files:
+        for file, csv_data in read_sessions(root_path, prepare=relative_features):
             print(file)
-            csv_data = pd.read_csv(os.path.join(root_path, file))
-
-            csv_data['relativeHandRPosx'] = csv_data['headPosx'] - csv_data['handRPosx']
-            csv_data['relativeHandRPosy'] = csv_data['headPosy'] - csv_data['handRPosy']
-            csv_data['relativeHandRPosz'] = csv_data['headPosz'] - csv_data['handRPosz']
-            csv_data['relativeHandLPosx'] = csv_data['headPosx'] - csv_data['handLPosx']
-            csv_data['relativeHandLPosy'] = csv_data['headPosy'] - csv_data['handLPosy']
-            csv_data['relativeHandLPosz'] = csv_data['headPosz'] - csv_data['handLPosz']
-            csv_data['relativeTracker1Posx'] = csv_data['headPosx'] - csv_data['tracker1Posx']
-            csv_data['relativeTracker1Posy'] = csv_data['headPosy'] - csv_data['tracker1Posy']
-            csv_data['relativeTracker1Posz'] = csv_data['headPosz'] - csv_data['tracker1Posz']
-
-            rowsPerGrab = 0
-            grabIndices = csv_data.index[
-                csv_data['gesture'] != "None"].tolist()  # find indices of rows that represent the end of a gesture
-            for i in range(len(grabIndices)):
-                csv_data.iloc[(grabIndices[i] - rowsPerGrab): grabIndices[i]]['gesture'] = csv_data.iloc[grabIndices[i]]['gesture']
-                all_data.append(csv_data.iloc[(grabIndices[i] - rowsPerGrab): grabIndices[i] + 1])
-        #print(len(grabIndices))
-        #print(len(all_data))
-        #for i in all_data:
-            #print(i['gesture'])
-        numRows = 0;
-        for i in all_data:
-            numRows += len(i)
-        print(numRows)
+            rows, grabs = grab_segments(csv_data['gesture'].to_numpy(), rows_per_grab)
+            segments = csv_data.take(rows)
+            # every row of a segment is labelled with the gesture of the grab it leads up to
+            segments['gesture'] = csv_data['gesture'].to_numpy()[grabs]
+            all_data.append(segments)
+        print(sum(len(segments) for segments in all_data))
         # Concatenate all data
         self.data = pd.concat(all_data, axis=0, ignore_index=True)
         #print(len(self.data))
@@ -542,18 +605,9 @@ class GrabCSVDataset(torch.utils.data.Dataset):
 class NumpadTypingCSVDataset(torch.utils.data.Dataset):
     def __init__(self, root_path, data_type):
         self.data_type = data_type
-        files = os.listdir(root_path)
-        files = [f for f in files if f.endswith('.csv')]
         all_data = []
 
-        for file in files:
-            csv_data = pd.read_csv(os.path.join(root_path, file)).iloc[:,1:32]
-            csv_data['relativeHandRPosx'] = csv_data['headPosx'] - csv_data['handRPosx']
-            csv_data['relativeHandRPosy'] = csv_data['headPosy'] - csv_data['handRPosy']
-            csv_data['relativeHandRPosz'] = csv_data['headPosz'] - csv_data['handRPosz']
-            csv_data['relativeHandLPosx'] = csv_data['headPosx'] - csv_data['handLPosx']
-            csv_data['relativeHandLPosy'] = csv_data['headPosy'] - csv_data['handLPosy']
-            csv_data['relativeHandLPosz'] = csv_data['headPosz'] - csv_data['handLPosz']
+        for file, csv_data in read_sessions(root_path, columns=slice(1,32), prepare=relative_hand_features):
             all_data.append(csv_data)
         # Concatenate all data
         self.data = pd.concat(all_data, axis=0, ignore_index=True)
@@ -654,18 +708,9 @@ class TypingCSVDataset(torch.utils.data.Dataset):
     def __init__(self, root_path, data_type, hand):
         self.data_type = data_type
         self.hand = hand
-        files = os.listdir(root_path)
-        files = [f for f in files if f.endswith('.csv')]
         all_data = []
 
-        for file in files:
-            csv_data = pd.read_csv(os.path.join(root_path, file)).iloc[:,1:33]
-            csv_data['relativeHandRPosx'] = csv_data['headPosx'] - csv_data['handRPosx']
-            csv_data['relativeHandRPosy'] = csv_data['headPosy'] - csv_data['handRPosy']
-            csv_data['relativeHandRPosz'] = csv_data['headPosz'] - csv_data['handRPosz']
-            csv_data['relativeHandLPosx'] = csv_data['headPosx'] - csv_data['handLPosx']
-            csv_data['relativeHandLPosy'] = csv_data['headPosy'] - csv_data['handLPosy']
-            csv_data['relativeHandLPosz'] = csv_data['headPosz'] - csv_data['handLPosz']
+        for file, csv_data in read_sessions(root_path, columns=slice(1,33), prepare=relative_hand_features):
             all_data.append(csv_data)
         # Concatenate all data
         self.data = pd.concat(all_data, axis=0, ignore_index=True)
@@ -0,0 +1,44 @@
+import torch
+
+import os
+import argparse
+
+from utils import Config
+from model import ScaledModel
+from checkpoint import export_onnx
+from predictor import PREDICTORS, load_predictor
+
+
+def export(predictor, path):
+    """Exports a Predictor as one ONNX graph with the scaler.json transforms folded in
+
+    The graph takes the raw (unscaled) model inputs, shaped (batch, *predictor.inputs.columns.shape),
+    and returns raw units for regressors and the logits for classifiers. Any batch size
+    (and for the LSTMRegressor any number of frames) can be fed.
+    """
+    scale, min_ = predictor.scale, predictor.min
+    if getattr(predictor.model, 'frame_axis', None) is not None:
+        # every frame of a window is scaled the same, per column scaling broadcasts over any number of frames
+        scale, min_ = scale[0], min_[0]
+    if predictor.output_columns is not None:
+        graph = ScaledModel(predictor.model, scale, min_, predictor.inv_scale, predictor.offset)
+    else:
+        graph = ScaledModel(predictor.model, scale, min_)
+    graph = graph.cpu().eval()
+    dummy_input = torch.zeros((1,) + predictor.inputs.columns.shape)
+    export_onnx(graph, dummy_input, path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exports a trained model with its input scaling and output inverse scaling as one ONNX graph')
+    parser.add_argument('--model', default='regressor', choices=[kind for kind, entry in PREDICTORS.items() if not entry[4]],
+                        help='a predictor.PREDICTORS entry, stream entries export as their window model')
+    parser.add_argument('--checkpoint', default=os.path.join(Config['model_path'], 'checkpoints', 'model_final.pth'))
+    parser.add_argument('--scaler', default=os.path.join(Config['model_path'], 'scaler.json'))
+    parser.add_argument('--labels', default=None, help='labels.json of a classifier')
+    parser.add_argument('--out', default=os.path.join(Config['model_path'], 'checkpoints', 'model_final_raw.onnx'))
+    args = parser.parse_args()
+
+    predictor = load_predictor(args.model, args.checkpoint, args.scaler, args.labels)
+    export(predictor, args.out)
+    print(f'Exported {args.model} to {args.out}, inputs:', ', '.join(dict.fromkeys(predictor.inputs.columns.ravel().tolist())))
@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+
+# Registry of derived features: name -> (minuend column, subtrahend column)
+FEATURES = {}
+
+
+def register_feature(name, minuend, subtrahend):
+    FEATURES[name] = (minuend, subtrahend)
+
+
+for axis in ['x', 'y', 'z']:
+    register_feature('relativeHandRPos' + axis, 'headPos' + axis, 'handRPos' + axis)
+for axis in ['x', 'y', 'z']:
+    register_feature('relativeHandLPos' + axis, 'headPos' + axis, 'handLPos' + axis)
+for axis in ['x', 'y', 'z']:
+    register_feature('relativeTracker1Pos' + axis, 'headPos' + axis, 'tracker1Pos' + axis)
+
+RELATIVE_HAND_FEATURES = ['relativeHandRPosx', 'relativeHandRPosy', 'relativeHandRPosz',
+                          'relativeHandLPosx', 'relativeHandLPosy', 'relativeHandLPosz']
+RELATIVE_TRACKER_FEATURES = ['relativeTracker1Posx', 'relativeTracker1Posy', 'relativeTracker1Posz']
+
+
+class FeatureEngine:
+    """Derives a set of registered features in a single vectorized pass.
+
+    The same engine serves whole sessions (DataFrames or (frames, columns)
+    arrays) during training and single live frames during inference, so both
+    always see identical features. Engines are picklable and can be passed as
+    the prepare step of ingest.read_sessions.
+
+    Args-
+        features- Names of registered features to derive, in output order
+        suffixes- Frame suffixes of wide CSVs ('0'...'9' for the gesture CSVs),
+            every feature is derived once per suffix
+    """
+    def __init__(self, features, suffixes=('',)):
+        self.names = [f + s for s in suffixes for f in features]
+        self.minuends = [FEATURES[f][0] + s for s in suffixes for f in features]
+        self.subtrahends = [FEATURES[f][1] + s for s in suffixes for f in features]
+        self.sources = list(dict.fromkeys(self.minuends + self.subtrahends))
+        self._indices = {}
+
+    def indices(self, columns):
+        """Positions of the minuend and subtrahend of every feature within columns"""
+        key = tuple(columns)
+        if key not in self._indices:
+            columns = list(columns)
+            self._indices[key] = (
+                np.array([columns.index(c) for c in self.minuends]),
+                np.array([columns.index(c) for c in self.subtrahends])
+            )
+        return self._indices[key]
+
+    def compute(self, block, columns):
+        """Returns only the derived features of a (..., len(columns)) array"""
+        minuend_idx, subtrahend_idx = self.indices(columns)
+        return block[..., minuend_idx] - block[..., subtrahend_idx]
+
+    def transform(self, block, columns):
+        """Appends the derived features to a (..., len(columns)) array, one frame or many"""
+        block = np.asarray(block)
+        out = np.empty(block.shape[:-1] + (block.shape[-1] + len(self.names),), dtype=block.dtype)
+        out[..., :block.shape[-1]] = block
+        minuend_idx, subtrahend_idx = self.indices(columns)
+        np.subtract(block[..., minuend_idx], block[..., subtrahend_idx], out=out[..., block.shape[-1]:])
+        return out
+
+    def __call__(self, csv_data):
+        """Returns csv_data with the derived features appended, computed in the dtype of the source columns"""
+        block = np.ascontiguousarray(csv_data[self.sources].to_numpy())
+        derived = pd.DataFrame(self.compute(block, self.sources), columns=self.names, index=csv_data.index)
+        return pd.concat([csv_data, derived], axis=1)
+
+
+# Head relative hand and tracker positions, used by the waist tracker and grab datasets
+relative_features = FeatureEngine(RELATIVE_HAND_FEATURES + RELATIVE_TRACKER_FEATURES)
+# Head relative hand positions only, used by the gesture and typing datasets
+relative_hand_features = FeatureEngine(RELATIVE_HAND_FEATURES)
+# relative_hand_features for each of the 10 frames of a wide gesture CSV
+relative_hand_features_per_frame = FeatureEngine(RELATIVE_HAND_FEATURES, suffixes=[str(i) for i in range(0, 10)])
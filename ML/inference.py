@@ -1,14 +1,134 @@
 import torch
 
 from utils import Config
-from model import Regressor, Regressorv2
-from data import CSVDataset
+from model import Regressor, Regressorv2, ScaledModel
+from data import CSVDataset, OUTPUT_TYPES, collate_batch
 
+import os
 import json
+import argparse
+import numpy as np
 import pandas as pd
-from tqdm import tqdm 
+from tqdm import tqdm
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+def inverse_scaler(scaler, columns, device='cpu'):
+    """Per-column (scale, offset) tensors undoing the MinMax scaling of columns in one affine transform
+
+    Args-
+        scaler- Contents of a scaler.json (see Scaler/export_scaler.py)
+        columns- Names of the scaled columns, in the order of the model outputs
+        device- Device of the returned tensors
+
+    Returns-
+        inv_scale, offset such that outputs * inv_scale + offset == (outputs - min) / scale
+    """
+    params = {param['type']: param for param in scaler['scalers']}
+    scale = np.array([params[column]['scale'] for column in columns], dtype=np.float64)
+    min_ = np.array([params[column]['min'] for column in columns], dtype=np.float64)
+    inv_scale = torch.tensor(1 / scale, dtype=torch.float32, device=device)
+    offset = torch.tensor(-min_ / scale, dtype=torch.float32, device=device)
+    return inv_scale, offset
+
+
+def fold_scaler(model, scaler, input_columns, output_columns=None):
+    """ScaledModel of model taking input_columns and, for a regressor, returning output_columns in raw units
+
+    Args-
+        model- Model trained on the MinMax scaled columns of scaler
+        scaler- Contents of a scaler.json (see Scaler/export_scaler.py)
+        input_columns- Names of the model inputs, in input order
+        output_columns- Names of the scaled regression outputs, None for classifiers
+    """
+    params = {param['type']: param for param in scaler['scalers']}
+    scale = [params[column]['scale'] for column in input_columns]
+    min_ = [params[column]['min'] for column in input_columns]
+    if output_columns is None:
+        return ScaledModel(model, scale, min_)
+    return ScaledModel(model, scale, min_, *inverse_scaler(scaler, output_columns))
+
+
+class OutputWriter:
+    """Appends chunks of predictions to a .csv or .parquet file (parquet needs pyarrow)
+
+    Args-
+        path- Output file, the format follows the extension
+        columns- Column names of the predictions
+    """
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = list(columns)
+        self.parquet = path.endswith('.parquet')
+        if self.parquet and pyarrow is None:
+            raise ImportError('Writing parquet needs pyarrow, install it or write a .csv')
+        self.writer = None
+        self.file = None
+
+    def write(self, values):
+        frame = pd.DataFrame(values, columns=self.columns, copy=False)
+        if self.parquet:
+            table = pyarrow.Table.from_pandas(frame, preserve_index=False)
+            if self.writer is None:
+                self.writer = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+            self.writer.write_table(table)
+        else:
+            header = self.file is None
+            if self.file is None:
+                self.file = open(self.path, 'w', newline='')
+            frame.to_csv(self.file, header=header, index=False)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if self.file is not None:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def predict(model, dataloader, inv_scale, offset, writer, device, prepare_batch=None):
+    """Runs model over dataloader and streams the inverse-scaled predictions to writer
+
+    Every batch goes to the device once, is scaled back with a single addcmul and
+    copied into a preallocated (pinned when on a GPU) host buffer before it is written.
+    """
+    buffer = None
+    with torch.inference_mode():
+        for inputs, labels in tqdm(dataloader):
+            inputs = inputs.to(device, non_blocking=True)
+            if prepare_batch is not None:
+                inputs, labels = prepare_batch(inputs, labels)
+            outputs = torch.addcmul(offset, model(inputs), inv_scale)
+            if buffer is None:
+                buffer = torch.empty((dataloader.batch_size, outputs.shape[1]), dtype=outputs.dtype,
+                                     pin_memory=outputs.is_cuda)
+            chunk = buffer[:outputs.shape[0]]
+            chunk.copy_(outputs, non_blocking=True)
+            if outputs.is_cuda:
+                torch.cuda.synchronize()
+            writer.write(chunk.numpy())
+
+
 if __name__=='__main__':
-    dataset = CSVDataset(root_path=Config['dataset_path'])
+    parser = argparse.ArgumentParser(description='Predicts the tracker pose of every frame of the sessions in a dataset')
+    parser.add_argument('--dataset_path', default=Config['dataset_path'])
+    parser.add_argument('--checkpoint', default=os.path.join(Config['model_path'], 'checkpoints', 'model_final.pth'))
+    parser.add_argument('--scaler', default=os.path.join(Config['model_path'], 'scaler.json'))
+    parser.add_argument('--out', default='output.csv', help='.csv or .parquet')
+    parser.add_argument('--batch_size', type=int, default=65536)
+    args = parser.parse_args()
+
+    dataset = CSVDataset(root_path=args.dataset_path)
     if Config['data_type']=='euler':
         model = Regressor(input_size=18, output_size=6)
     elif Config['data_type']=='quaternion':
@@ -16,57 +136,25 @@ if __name__=='__main__':
     elif Config['data_type']=='both':
         model = Regressor(input_size=30, output_size=10)
     elif Config['data_type']=='relative':
-        model = Regressorv2(input_size=19, output_size=7) 
-
-    # csv_data = pd.read_csv('/home/adityan/Studies/CSCI527/alt/XR-Interaction-Toolkit-Examples/ML/Data_Exp/Exp0/BeatSaber_2_processed.csv')
+        model = Regressorv2(input_size=19, output_size=7)
 
     device = torch.device('cuda:0' if torch.cuda.is_available() and Config['use_cuda'] else 'cpu')
-    model.load_state_dict(torch.load('/home/adityan/Studies/CSCI527/alt/XR-Interaction-Toolkit-Examples/ML/models/regressorv2_run2/checkpoints/model_169.pth'))
+    model.load_state_dict(torch.load(args.checkpoint, map_location=device))
     model.to(device)
-    scaler_file = '/home/adityan/Studies/CSCI527/alt/XR-Interaction-Toolkit-Examples/ML/models/regressorv3/scaler.json'
-    scaler = json.load(open(scaler_file,'r'))
-    print(scaler)
-    scalerDict = dict()
-    for param in scaler['scalers']:
-        scalerDict.update({param['type']: [param['min'], param['scale']]})
+    model.eval()
+    with open(args.scaler, 'r') as f:
+        scaler = json.load(f)
+    label_names = OUTPUT_TYPES[Config['data_type']][1]
+    inv_scale, offset = inverse_scaler(scaler, label_names, device)
 
     test_loader = torch.utils.data.DataLoader(
                         dataset,
-                        batch_size = 1,
+                        batch_size = args.batch_size,
                         shuffle=False,
-                        num_workers = Config['num_workers']
+                        num_workers = Config['num_workers'],
+                        collate_fn = collate_batch,
+                        pin_memory = device.type == 'cuda'
                     )
 
-    model.eval()
-    out_file = open('out.csv','w')
-
-    predictedData=pd.DataFrame()
-    for i, (inputs, labels) in enumerate(test_loader):
-        # row = csv_data.iloc[i,1:41]
-        # print(row)
-        with torch.set_grad_enabled(False):
-            inputs = inputs.to(device)
-            labels = labels.to(device)
-
-            outputs = model(inputs)
-
-            
-            print('Expected: ', labels)
-            print('Predicted: ', outputs)
-            outputs[:,0] = (outputs[:,0]-scalerDict['relativeTracker1Posx'][0])/scalerDict['relativeTracker1Posx'][1]
-            outputs[:,1] = (outputs[:,1]-scalerDict['relativeTracker1Posy'][0])/scalerDict['relativeTracker1Posy'][1]
-            outputs[:,2] = (outputs[:,2]-scalerDict['relativeTracker1Posz'][0])/scalerDict['relativeTracker1Posz'][1]
-            outputs[:,3] = (outputs[:,3]-scalerDict['tracker1RotQx'][0])/scalerDict['tracker1RotQx'][1]
-            outputs[:,4] = (outputs[:,4]-scalerDict['tracker1RotQy'][0])/scalerDict['tracker1RotQy'][1]
-            outputs[:,5] = (outputs[:,5]-scalerDict['tracker1RotQz'][0])/scalerDict['tracker1RotQz'][1]
-            outputs[:,6] = (outputs[:,6]-scalerDict['tracker1RotQw'][0])/scalerDict['tracker1RotQw'][1]
-            # print(outputs.shape)
-
-
-            batch_df = pd.DataFrame(outputs.cpu().numpy().reshape(1, 7),
-                                columns=['relativeTracker1Posx', 'relativeTracker1Posy', 'relativeTracker1Posz', 'tracker1RotQx', 'tracker1RotQy', 'tracker1RotQz', 'tracker1RotQw'])
-
-            predictedData = predictedData.append(batch_df)
-            
-
-    predictedData.to_csv('output.csv', index = False)
\ No newline at end of file
+    with OutputWriter(args.out, label_names) as writer:
+        predict(model, test_loader, inv_scale, offset, writer, device)
@@ -0,0 +1,136 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+import pandas as pd
+
+from utils import Config
+from cache import read_session
+
+
+def list_sessions(root_path):
+    """Session CSVs of a dataset folder, sorted so that every run concatenates them in the same order"""
+    files = os.listdir(root_path)
+    return sorted(f for f in files if f.endswith('.csv'))
+
+
+def validate_session(path, csv_data, required):
+    missing = [c for c in required if c not in csv_data.columns]
+    if missing:
+        raise ValueError(f'{path} is missing columns {missing}')
+
+
+def load_session(path, columns=None, prepare=None, required=()):
+    csv_data = read_session(path, columns=columns)
+    validate_session(path, csv_data, required)
+    if prepare is not None:
+        csv_data = prepare(csv_data)
+    return csv_data
+
+
+def create_block(size):
+    """A new shared memory block the worker creating it does not clean up on exit, the parent unlinks it"""
+    try:
+        return shared_memory.SharedMemory(create=True, size=size, track=False)
+    except TypeError:
+        # before Python 3.13 every block is tracked, it is registered under its POSIX name with the leading slash
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        if os.name == 'posix':
+            resource_tracker.unregister('/' + shm.name, 'shared_memory')
+        return shm
+
+
+def release_blocks(blocks):
+    for name, _, _, _ in blocks:
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            continue
+        shm.close()
+        shm.unlink()
+
+
+def share_frame(csv_data):
+    """Moves the numeric columns of a frame into shared memory, one (columns, rows) block per dtype.
+
+    Every column is written straight into its block, only the block names and
+    the (small) non-numeric columns are pickled back to the parent process.
+    """
+    blocks = []
+    objects = {}
+    by_dtype = {}
+    for name in csv_data.columns:
+        if pd.api.types.is_numeric_dtype(csv_data[name]):
+            by_dtype.setdefault(csv_data[name].dtype.str, []).append(name)
+        else:
+            objects[name] = csv_data[name].to_numpy()
+    try:
+        for dtype, names in by_dtype.items():
+            shape = (len(names), len(csv_data))
+            shm = create_block(max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1))
+            blocks.append((shm.name, shape, dtype, names))
+            values = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+            for idx, name in enumerate(names):
+                values[idx] = csv_data[name].to_numpy()
+            del values
+            shm.close()
+    except BaseException:
+        release_blocks(blocks)
+        raise
+    return list(csv_data.columns), blocks, objects
+
+
+def unshare_frame(shared):
+    """Rebuilds a frame from share_frame() and releases its shared memory, also when rebuilding fails"""
+    columns, blocks, objects = shared
+    data = dict(objects)
+    try:
+        for name, shape, dtype, names in blocks:
+            shm = shared_memory.SharedMemory(name=name)
+            try:
+                values = np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+            finally:
+                shm.close()
+                shm.unlink()
+            for idx, column in enumerate(names):
+                data[column] = values[idx]
+    finally:
+        release_blocks(blocks)
+    return pd.DataFrame({column: data[column] for column in columns})
+
+
+def load_shared_session(path, columns=None, prepare=None, required=()):
+    return share_frame(load_session(path, columns, prepare, required))
+
+
+def read_sessions(root_path, columns=None, prepare=None, required=(), num_workers=Config['num_ingest_workers']):
+    """Reads, derives and validates every session CSV of a folder.
+
+    Sessions are fanned out to a pool of num_workers processes. prepare is
+    applied to every session inside the workers, so it has to be picklable
+    (a module level function or a functools.partial of one).
+
+    Returns-
+        A list of (file name, DataFrame) pairs in list_sessions() order
+    """
+    files = list_sessions(root_path)
+    paths = [os.path.join(root_path, f) for f in files]
+    if num_workers <= 1 or len(paths) <= 1:
+        return [(f, load_session(p, columns, prepare, required)) for f, p in zip(files, paths)]
+
+    with ProcessPoolExecutor(max_workers=min(num_workers, len(paths))) as executor:
+        futures = [executor.submit(load_shared_session, p, columns, prepare, required) for p in paths]
+        sessions = []
+        try:
+            # collected in submission order, so the result does not depend on which worker finishes first
+            for f, future in zip(files, futures):
+                sessions.append((f, unshare_frame(future.result())))
+        finally:
+            # a session failed, the blocks of every session not collected yet are unlinked here
+            for future in futures[len(sessions):]:
+                future.cancel()
+            for future in futures[len(sessions):]:
+                if not future.cancelled() and future.exception() is None:
+                    release_blocks(future.result()[1])
+        return sessions
@@ -0,0 +1,246 @@
+import torch
+import numpy as np
+
+import json
+import random
+import asyncio
+import argparse
+
+from utils import Config
+from ingest import read_sessions
+from predictor import FRAME_COLUMNS
+from serve import InferenceServer, load_graph
+
+# Every simulated headset replays one recorded session (cycling through them) as
+# an open loop, frame i is sent at start + i / (fps * speedup) whether or not
+# the previous frames were answered. Latency is measured from the time a frame
+# was due, not from when it was actually sent, so a client or server that falls
+# behind shows up in the tail instead of silently slowing the replay down.
+
+
+def percentiles(values):
+    if len(values) == 0:
+        return None
+    values = np.asarray(values) * 1000
+    return {'p50': float(np.percentile(values, 50)), 'p95': float(np.percentile(values, 95)),
+            'p99': float(np.percentile(values, 99)), 'max': float(values.max()), 'mean': float(values.mean())}
+
+
+class Headset:
+    """Due times and latencies of the frames of one simulated headset"""
+    def __init__(self):
+        self.due = {}
+        self.latencies = []
+        self.late = 0
+        self.done = asyncio.Event()
+        self.expected = None
+
+    def received(self, data, deadline):
+        seq = json.loads(data)['seq']
+        due = self.due.pop(seq, None)
+        if due is None:
+            return
+        latency = asyncio.get_running_loop().time() - due
+        self.latencies.append(latency)
+        if latency > deadline:
+            self.late += 1
+        if self.expected is not None and len(self.latencies) >= self.expected:
+            self.done.set()
+
+
+class LocalClient:
+    """A session of an in-process InferenceServer, frames skip the socket but keep the JSON protocol"""
+    def __init__(self, server, session, on_response):
+        self.server = server
+        self.session = session
+        self.on_response = on_response
+        self.tail = None
+
+    async def open(self):
+        pass
+
+    def send(self, message):
+        # frames of a session are handled in order, as on a TCP connection
+        self.tail = asyncio.ensure_future(self.handle(message, self.tail))
+
+    async def handle(self, message, previous):
+        if previous is not None:
+            await asyncio.wait([previous])
+        self.on_response(await self.server.handle_frame(self.session, message))
+
+    def close(self):
+        if self.tail is not None:
+            self.tail.cancel()
+        self.server.close_session(self.session)
+
+
+class TCPClient:
+    def __init__(self, host, port, on_response):
+        self.host = host
+        self.port = port
+        self.on_response = on_response
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.receiver = asyncio.create_task(self.receive())
+
+    async def receive(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                break
+            self.on_response(line)
+
+    def send(self, message):
+        self.writer.write(message)
+
+    def close(self):
+        self.receiver.cancel()
+        self.writer.close()
+
+
+class UDPClient(asyncio.DatagramProtocol):
+    def __init__(self, host, port, on_response):
+        self.host = host
+        self.port = port
+        self.on_response = on_response
+        self.transport = None
+
+    async def open(self):
+        await asyncio.get_running_loop().create_datagram_endpoint(lambda: self, remote_addr=(self.host, self.port))
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.on_response(data)
+
+    def send(self, message):
+        self.transport.sendto(message)
+
+    def close(self):
+        self.transport.close()
+
+
+def load_frames(root_path):
+    """Raw frames of every session CSV of a dataset folder, as the per-frame JSON a headset sends"""
+    sessions = read_sessions(root_path, columns=slice(1, 41), required=FRAME_COLUMNS)
+    return [[json.dumps(row) for row in csv_data[FRAME_COLUMNS].to_numpy(dtype=np.float64).tolist()] for _, csv_data in sessions]
+
+
+async def replay(client, headset, frames, num_frames, interval, start):
+    loop = asyncio.get_running_loop()
+    await client.open()
+    for seq in range(num_frames):
+        due = start + seq * interval
+        delay = due - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        headset.due[seq] = due
+        client.send(b'{"seq": %d, "frame": %s}\n' % (seq, frames[seq % len(frames)].encode()))
+
+
+async def loadtest(sessions, make_client, num_headsets=10, fps=Config['headset_fps'], speedup=1.0, duration=10.0,
+                   deadline=None, timeout=1.0, seed=0):
+    """Replays sessions from num_headsets concurrent headsets and measures the responses
+
+    Args-
+        sessions- Per session, the JSON of every raw frame (see load_frames)
+        make_client- Called with (headset index, response callback), returns a client with open/send/close
+        num_headsets- Concurrent simulated headsets
+        fps- Frame rate of a headset in real time
+        speedup- Replay speed, frames are sent every 1 / (fps * speedup) seconds
+        duration- Seconds every headset streams for (at replay speed)
+        deadline- Seconds after which a response counts as a dropped frame, defaults to one frame interval
+        timeout- Seconds to wait for outstanding responses once every frame is sent
+        seed- Seed of the start offsets that spread the headsets over a frame interval
+
+    Returns-
+        The report as a dict
+    """
+    loop = asyncio.get_running_loop()
+    interval = 1 / (fps * speedup)
+    deadline = interval if deadline is None else deadline
+    num_frames = max(1, int(duration / interval))
+    rng = random.Random(seed)
+
+    headsets = [Headset() for _ in range(num_headsets)]
+    clients = [make_client(idx, lambda data, headset=headset: headset.received(data, deadline))
+               for idx, headset in enumerate(headsets)]
+    start = loop.time() + 0.1
+    await asyncio.gather(*[replay(client, headset, sessions[idx % len(sessions)], num_frames, interval, start + rng.uniform(0, interval))
+                           for idx, (client, headset) in enumerate(zip(clients, headsets))])
+    for headset in headsets:
+        headset.expected = num_frames
+        if len(headset.latencies) >= num_frames:
+            headset.done.set()
+    await asyncio.wait([asyncio.ensure_future(headset.done.wait()) for headset in headsets], timeout=timeout)
+    elapsed = loop.time() - start
+    for client in clients:
+        client.close()
+
+    latencies = [latency for headset in headsets for latency in headset.latencies]
+    sent = num_frames * num_headsets
+    lost = sum(len(headset.due) for headset in headsets)
+    late = sum(headset.late for headset in headsets)
+    return {
+        'headsets': num_headsets,
+        'fps': fps,
+        'speedup': speedup,
+        'offered_fps': num_headsets / interval,
+        'frames_sent': sent,
+        'responses': len(latencies),
+        'elapsed_s': elapsed,
+        'throughput_fps': len(latencies) / elapsed,
+        'latency_ms': percentiles(latencies),
+        'deadline_ms': deadline * 1000,
+        'dropped': {'late': late, 'lost': lost, 'total': late + lost, 'rate': (late + lost) / sent},
+    }
+
+
+async def run(args, sessions):
+    if args.target == 'local':
+        torch.set_num_threads(args.threads)
+        server = InferenceServer(load_graph(args.model), args.max_batch, args.max_delay_ms / 1000)
+        batcher = asyncio.create_task(server.batcher.run())
+        make_client = lambda idx, on_response: LocalClient(server, ('loadtest', idx), on_response)
+    elif args.target == 'tcp':
+        make_client = lambda idx, on_response: TCPClient(args.host, args.port, on_response)
+    else:
+        make_client = lambda idx, on_response: UDPClient(args.host, args.port + 1, on_response)
+    try:
+        return await loadtest(sessions, make_client, args.headsets, args.fps, args.speedup, args.duration,
+                              None if args.deadline_ms is None else args.deadline_ms / 1000, args.timeout, args.seed)
+    finally:
+        if args.target == 'local':
+            batcher.cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replays recorded sessions from many simulated headsets against the inference path')
+    parser.add_argument('--dataset_path', default=Config['dataset_path'], help='folder of session CSVs')
+    parser.add_argument('--target', choices=['local', 'tcp', 'udp'], default='local',
+                        help='local runs the models of --model in this process, tcp/udp send to a running serve.py')
+    parser.add_argument('--model', action='append', metavar='NAME=KIND,CHECKPOINT,SCALER[,LABELS]', help='models of --target local, as in serve.py')
+    parser.add_argument('--host', default=Config['serve_host'])
+    parser.add_argument('--port', type=int, default=Config['serve_port'], help='TCP port of serve.py, udp uses port+1')
+    parser.add_argument('--headsets', type=int, default=10)
+    parser.add_argument('--fps', type=float, default=Config['headset_fps'])
+    parser.add_argument('--speedup', type=float, default=1.0, help='replay at speedup times real time')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds every headset streams for')
+    parser.add_argument('--deadline_ms', type=float, default=None, help='later responses count as dropped, defaults to one frame interval')
+    parser.add_argument('--timeout', type=float, default=1.0, help='seconds to wait for the last responses')
+    parser.add_argument('--max_batch', type=int, default=Config['serve_max_batch'])
+    parser.add_argument('--max_delay_ms', type=float, default=Config['serve_max_delay_ms'])
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='loadtest.json')
+    args = parser.parse_args()
+    if args.target == 'local' and not args.model:
+        parser.error('--target local needs at least one --model')
+
+    report = asyncio.run(run(args, load_frames(args.dataset_path)))
+    report.update(target=args.target, models=args.model)
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=1)
+    print(json.dumps(report, indent=1))
@@ -1,12 +1,13 @@
 from utils import Config
 import torch
 import os
+import argparse
 import pandas as pd
 import numpy as np
 from model import LSTMRegressor
-from data import LSTMCSVDataset
-from sklearn.preprocessing import MinMaxScaler
-import csv
+from data import OUTPUT_TYPES
+from features import relative_features
+from inference import inverse_scaler, OutputWriter, predict
 import json
 pd.options.mode.chained_assignment = None  # default='warn' ##
 
@@ -22,102 +23,69 @@ pd.options.mode.chained_assignment = None  # default='warn' ##
 #     }
 
 
+class WindowBatches:
+    """Batches of the look_back windows of one scaled session, every window starts one frame later
 
-if __name__=='__main__':
-    src_file = r'C:\Users\CSCI-538-HP-Z240-lll\Desktop\UnityProjects\XR-Interaction-Toolkit-Examples\VR\Assets\XROSUI\ML_Model\Exp0_ 2021-02-19-02-12-11 - Duplicates Removed.csv'
-    scaler_file = r'C:\Users\CSCI-538-HP-Z240-lll\Desktop\UnityProjects\XR-Interaction-Toolkit-Examples\VR\Assets\XROSUI\ML_Model\lstm_scaler.json'
-    scaler = json.load(open(scaler_file,'r'))
-
-    model = LSTMRegressor(input_size=19, output_size=7)
-    device = torch.device('cuda:0' if torch.cuda.is_available() and Config['use_cuda'] else 'cpu')
-    model.load_state_dict(torch.load(r'C:\Users\CSCI-538-HP-Z240-lll\Desktop\UnityProjects\XR-Interaction-Toolkit-Examples\VR\Assets\XROSUI\ML_Model\lstm_model_run7_884.pth'))
-    model.to(device)
-    model.eval()
-
-
-    scalerDict = dict()
-    for param in scaler['scalers']:
-        scalerDict.update({param['type']: [param['min'], param['scale']]})
-    # print(scaler)
-    # print(scalerDict)
-    lookback = 10
-    step_value = 1
-    csv_data = pd.read_csv(src_file).iloc[:, 1:41]
-
-    csv_data['relativeHandRPosx'] = csv_data['headPosx'] - csv_data['handRPosx']
-    csv_data['relativeHandRPosy'] = csv_data['headPosy'] - csv_data['handRPosy']
-    csv_data['relativeHandRPosz'] = csv_data['headPosz'] - csv_data['handRPosz']
-    csv_data['relativeHandLPosx'] = csv_data['headPosx'] - csv_data['handLPosx']
-    csv_data['relativeHandLPosy'] = csv_data['headPosy'] - csv_data['handLPosy']
-    csv_data['relativeHandLPosz'] = csv_data['headPosz'] - csv_data['handLPosz']
-    csv_data['relativeTracker1Posx'] = csv_data['headPosx'] - csv_data['tracker1Posx']
-    csv_data['relativeTracker1Posy'] = csv_data['headPosy'] - csv_data['tracker1Posy']
-    csv_data['relativeTracker1Posz'] = csv_data['headPosz'] - csv_data['tracker1Posz']
-
-    rows = []
-    out_file = open('out.csv','w')
-
-    predictedData = pd.DataFrame(
-        columns=['relativeTracker1Posx', 'relativeTracker1Posy', 'relativeTracker1Posz', 'tracker1Rotx',
-                 'tracker1Roty', 'tracker1Rotz'])
+    Args-
+        frames- (frames, features) float32 array, already scaled
+        look_back- Frames per window
+        step_value- Stride between the frames of a window
+        batch_size- Windows per batch
+    """
+    def __init__(self, frames, look_back=10, step_value=1, batch_size=4096):
+        # strided view (windows, look_back/step_value, features), nothing is copied
+        windows = np.lib.stride_tricks.sliding_window_view(frames, look_back, axis=0).transpose(0, 2, 1)[:, ::step_value]
+        # same windows as the frame by frame loop this replaces
+        self.windows = windows[:max(len(frames) - look_back - 1, 0)]
+        self.batch_size = batch_size
 
-    for i in range(len(csv_data)-lookback-1):
-        a = csv_data.iloc[i:(i+lookback):step_value, :]
+    def __len__(self):
+        return (len(self.windows) + self.batch_size - 1) // self.batch_size
 
-        orig = np.array(a.copy())
-        for key in list(a.keys()):
-            a[key] = a[key] * scalerDict[key][1] + scalerDict[key][0]
-        a = a[['headPosy','headRotQx','headRotQy','headRotQz', 'headRotQw','relativeHandRPosx','relativeHandRPosy','relativeHandRPosz','handRRotQx', 'handRRotQy', 'handRRotQz', 'handRRotQw', 'relativeHandLPosx', 'relativeHandLPosy', 'relativeHandLPosz','handLRotQx','handLRotQy','handLRotQz', 'handLRotQw']]
+    def __iter__(self):
+        for start in range(0, len(self.windows), self.batch_size):
+            yield torch.from_numpy(np.ascontiguousarray(self.windows[start:start+self.batch_size])), None
 
 
-        record = np.array(a)
-        with torch.set_grad_enabled(False):
-            model.h1, model.h2 = model.init_hidden(1,'cuda:0')
-            outputs = model(torch.FloatTensor(record).to(device).unsqueeze(0))
-        #print(outputs.shape)
-        outputs = torch.squeeze(outputs)
-        #print(outputs.shape)
-        last_output = outputs[9,:]
-        #print(last_output.shape)
+def scale_frames(csv_data, columns, scaler):
+    """Applies the scaler.json transform (x * scale + min) to columns of csv_data in one vectorized op"""
+    params = {param['type']: param for param in scaler['scalers']}
+    scale = np.array([params[column]['scale'] for column in columns])
+    min_ = np.array([params[column]['min'] for column in columns])
+    return (csv_data[columns].to_numpy(dtype=np.float64) * scale + min_).astype(np.float32)
 
 
-        last_output[0] = (last_output[0] - scalerDict['relativeTracker1Posx'][0]) / scalerDict['relativeTracker1Posx'][1]
-        last_output[1] = (last_output[1] - scalerDict['relativeTracker1Posy'][0]) / scalerDict['relativeTracker1Posy'][1]
-        last_output[2] = (last_output[2] - scalerDict['relativeTracker1Posz'][0]) / scalerDict['relativeTracker1Posz'][1]
-        last_output[3] = (last_output[3] - scalerDict['tracker1RotQx'][0]) / scalerDict['tracker1RotQx'][1]
-        last_output[4] = (last_output[4] - scalerDict['tracker1RotQy'][0]) / scalerDict['tracker1RotQy'][1]
-        last_output[5] = (last_output[5] - scalerDict['tracker1RotQz'][0]) / scalerDict['tracker1RotQz'][1]
-        last_output[6] = (last_output[6] - scalerDict['tracker1RotQw'][0]) / scalerDict['tracker1RotQw'][1]
-
-        #print(last_output)
-        batch_df = pd.DataFrame(last_output.cpu().numpy().reshape(1, 7),
-                                columns=['relativeTracker1Posx', 'relativeTracker1Posy', 'relativeTracker1Posz',
-                                         'tracker1RotQx', 'tracker1RotQy', 'tracker1RotQz', 'tracker1RotQw'])
-        #print(batch_df.to_string(index = False))
-        predictedData = predictedData.append(batch_df)
-
-        #
-        # outputs[:,:,0] = outputs[:,:,0]-scalerDict['relativeTracker1Posx'][0]/scalerDict['relativeTracker1Posx'][1]
-        # outputs[:,:,1] = outputs[:,:,1]-scalerDict['relativeTracker1Posy'][0]/scalerDict['relativeTracker1Posy'][1]
-        # outputs[:,:,2] = outputs[:,:,2]-scalerDict['relativeTracker1Posz'][0]/scalerDict['relativeTracker1Posz'][1]
-        # outputs[:,:,3] = outputs[:,:,3]-scalerDict['tracker1Rotx'][0]/scalerDict['tracker1Rotx'][1]
-        # outputs[:,:,4] = outputs[:,:,4]-scalerDict['tracker1Roty'][0]/scalerDict['tracker1Roty'][1]
-        # outputs[:,:,5] = outputs[:,:,5]-scalerDict['tracker1Rotz'][0]/scalerDict['tracker1Rotz'][1]
-
-        # for i in range(lookback):
-        #     # print(outputs[0,i,:].cpu().numpy().tolist())
-        #     for data in orig[i]:
-        #         out_file.write(str(data)+',')
-        #     for data in outputs[0,9,:]: #changed from outputs[0,i,:] to outputs[0,9,:]
-        #         out_file.write(str(data.cpu().numpy().tolist())+',')
-        #     out_file.write('\n')
-
-
-
-    predictedData.to_csv(r'output.csv', index = False)
-    #out_file.close()
+def last_step(model):
+    # every window starts from a zero hidden state, only the output of its last frame is kept
+    return lambda inputs: model(inputs)[:, -1]
 
 
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Predicts the tracker pose of every frame of a session with an LSTMRegressor')
+    parser.add_argument('--src', required=True, help='session CSV')
+    parser.add_argument('--checkpoint', default=os.path.join(Config['model_path'], 'checkpoints', 'model_final.pth'))
+    parser.add_argument('--scaler', default=os.path.join(Config['model_path'], 'scaler.json'))
+    parser.add_argument('--out', default='output.csv', help='.csv or .parquet')
+    parser.add_argument('--look_back', type=int, default=10)
+    parser.add_argument('--step_value', type=int, default=1)
+    parser.add_argument('--batch_size', type=int, default=4096)
+    args = parser.parse_args()
+
+    with open(args.scaler, 'r') as f:
+        scaler = json.load(f)
 
+    model = LSTMRegressor(input_size=19, output_size=7)
+    device = torch.device('cuda:0' if torch.cuda.is_available() and Config['use_cuda'] else 'cpu')
+    model.load_state_dict(torch.load(args.checkpoint, map_location=device))
+    model.to(device)
+    model.eval()
 
+    input_names, label_names = OUTPUT_TYPES['relative']
+    csv_data = pd.read_csv(args.src).iloc[:, 1:41]
+    csv_data = relative_features(csv_data)
+    frames = scale_frames(csv_data, input_names, scaler)
 
+    inv_scale, offset = inverse_scaler(scaler, label_names, device)
+    windows = WindowBatches(frames, args.look_back, args.step_value, args.batch_size)
+    with OutputWriter(args.out, label_names) as writer:
+        predict(last_step(model), windows, inv_scale, offset, writer, device)
@@ -0,0 +1,138 @@
+import torch
+
+# Streaming metrics for the Trainer. Every metric keeps its running state as
+# tensors on the training device, update() never syncs with the host and
+# compute() reads the state back once per epoch.
+
+
+def axis_names(names, size):
+    if names is None:
+        return [str(idx) for idx in range(size)]
+    if isinstance(names, dict):
+        return [str(names.get(idx, idx)) for idx in range(size)]
+    return [str(name) for name in names]
+
+
+class BatchMean:
+    """Sample weighted mean of a per-batch metric, accumulated on device.
+
+    Args-
+        fn- Called with (outputs, labels) of every batch, returns a scalar tensor
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        self.reset()
+
+    def reset(self):
+        self.total = 0.0
+        self.count = 0
+
+    def update(self, outputs, labels):
+        self.total = self.total + self.fn(outputs, labels).detach() * outputs.shape[0]
+        self.count += outputs.shape[0]
+
+    def compute(self):
+        return float(self.total / max(self.count, 1))
+
+
+class ConfusionMatrix:
+    """Confusion matrix of a classifier built with one bincount per batch.
+
+    Reports the overall accuracy and the accuracy (recall) of every class, the
+    full (label, prediction) matrix is kept in self.matrix after compute().
+
+    Args-
+        num_classes- Number of model outputs
+        class_names- Optional list or {index: name} dict, reported as <metric>_<name>
+    """
+    def __init__(self, num_classes, class_names=None):
+        self.num_classes = num_classes
+        self.class_names = axis_names(class_names, num_classes)
+        self.reset()
+
+    def reset(self):
+        self.counts = None
+        self.matrix = None
+
+    def update(self, outputs, labels):
+        preds = outputs.argmax(dim=1)
+        labels = labels.reshape(-1).long()
+        counts = torch.bincount(labels * self.num_classes + preds, minlength=self.num_classes ** 2)
+        self.counts = counts if self.counts is None else self.counts + counts
+
+    def compute(self):
+        if self.counts is None:
+            return {}
+        self.matrix = self.counts.reshape(self.num_classes, self.num_classes).cpu()
+        corrects = self.matrix.diagonal()
+        totals = self.matrix.sum(dim=1)
+        results = {'': float(corrects.sum()) / max(int(totals.sum()), 1)}
+        for name, correct, total in zip(self.class_names, corrects.tolist(), totals.tolist()):
+            results[name] = correct / total if total else float('nan')
+        return results
+
+
+class R2Score:
+    """Coefficient of determination of every output over the whole epoch.
+
+    Keeps per-output sums of the labels, of their squares and of the squared
+    errors, so R2 is exact for the epoch instead of an average of batch scores.
+    Reports the mean over the outputs and the score of every output.
+
+    Args-
+        names- Optional names of the outputs (e.g. the label columns)
+    """
+    def __init__(self, names=None):
+        self.names = names
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.sums = None
+
+    def update(self, outputs, labels):
+        outputs = outputs.reshape(outputs.shape[0], -1).double()
+        labels = labels.reshape(labels.shape[0], -1).double()
+        sums = torch.stack([labels.sum(dim=0), labels.square().sum(dim=0), (labels - outputs).square().sum(dim=0)])
+        self.sums = sums if self.sums is None else self.sums + sums
+        self.count += labels.shape[0]
+
+    def compute(self):
+        if self.sums is None:
+            return {}
+        label_sum, label_sumsq, squared_error = self.sums.cpu()
+        total = label_sumsq - label_sum.square() / self.count
+        r2 = 1 - squared_error / total
+        results = {'': float(r2.mean())}
+        results.update(zip(axis_names(self.names, len(r2)), r2.tolist()))
+        return results
+
+
+class MeanAbsoluteError:
+    """Mean absolute error of every output over the whole epoch, plus their mean
+
+    Args-
+        names- Optional names of the outputs (e.g. the label columns)
+    """
+    def __init__(self, names=None):
+        self.names = names
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = None
+
+    def update(self, outputs, labels):
+        outputs = outputs.reshape(outputs.shape[0], -1)
+        labels = labels.reshape(labels.shape[0], -1)
+        total = (outputs - labels).abs().sum(dim=0, dtype=torch.float64)
+        self.total = total if self.total is None else self.total + total
+        self.count += labels.shape[0]
+
+    def compute(self):
+        if self.total is None:
+            return {}
+        mae = self.total.cpu() / self.count
+        results = {'': float(mae.mean())}
+        results.update(zip(axis_names(self.names, len(mae)), mae.tolist()))
+        return results
@@ -2,8 +2,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from utils import Config
-
 class Regressor(nn.Module):
     def __init__(self, input_size, output_size):
         super(Regressor, self).__init__()
@@ -71,10 +69,26 @@ class CNNRegressor(nn.Module):
     pass
 
 class LSTMRegressor(nn.Module):
-    def __init__(self, input_size, output_size):
+    """Two layer LSTM regressor with an explicit hidden state.
+
+    forward(x) runs windows (batch, frames, features) from a zero state and
+    returns the output of every frame. Trained on look_back frame windows, its
+    prediction for a frame is the last output of the window ending there.
+
+    step(frame, window) feeds one frame and returns exactly that prediction,
+    rerunning the window it keeps of the last look_back input frames.
+    stream(frame, state) runs the LSTM once per frame and carries the hidden
+    state instead, it matches forward over the first look_back frames from
+    init_state() but afterwards never restarts the state like window mode does.
+    """
+    # windows of any length, exported as a dynamic ONNX axis of the input and the output
+    frame_axis = 1
+
+    def __init__(self, input_size, output_size, look_back=10):
         super(LSTMRegressor,self).__init__()
         self.input_size = input_size
         self.output_size = output_size
+        self.look_back = look_back
 
         self.lstm_1 = nn.LSTM(self.input_size, 512, batch_first=True)
         # self.bn_1 = nn.BatchNorm1d(500)
@@ -83,27 +97,77 @@ class LSTMRegressor(nn.Module):
         # self.bn_2 = nn.BatchNorm1d(100)
         self.out = nn.Linear(256, output_size)
         # self.fc = nn.Linear(self.hidden_size, self.output_size)
-        self.h1, self.h2 = self.init_hidden(batch_size=Config['batch_size'],device='cuda:0')
 
-    def init_hidden(self, batch_size, device='cpu'):
-        return [(torch.zeros(1, batch_size , 512).to(device), torch.zeros(1, batch_size , 512).to(device)),
-                (torch.zeros(1, batch_size, 256).to(device), torch.zeros(1, batch_size, 256).to(device))]
-    
-    def forward(self, x, device='cpu'):
-        # print(x.shape)
-        # print(self.h1.shape)
-        out, self.h1 = self.lstm_1(x, self.h1)
+    def init_state(self, batch_size, device='cpu'):
+        return ((torch.zeros(1, batch_size, 512, device=device), torch.zeros(1, batch_size, 512, device=device)),
+                (torch.zeros(1, batch_size, 256, device=device), torch.zeros(1, batch_size, 256, device=device)))
+
+    def init_window(self, batch_size, device='cpu'):
+        return torch.zeros(batch_size, self.look_back, self.input_size, device=device)
+
+    def run(self, x, state):
+        out, h1 = self.lstm_1(x, state[0])
         out = self.dropout_1(out)
         out = nn.Tanh()(out)
-        out, self.h2 = self.lstm_2(out, self.h2)
-        print(out.shape)
+        out, h2 = self.lstm_2(out, state[1])
         # out = out.reshape(out.shape[0],-1)
-        print(out.shape)
         out = self.out(out)
-        return nn.Tanh()(out)
+        return nn.Tanh()(out), (h1, h2)
+
+    def forward(self, x, state=None):
+        if state is None:
+            state = self.init_state(x.shape[0], x.device)
+        return self.run(x, state)[0]
+
+    def step(self, frame, window):
+        window = torch.cat([window[:, 1:], frame.unsqueeze(1)], dim=1)
+        return self(window)[:, -1], window
+
+    def stream(self, frame, state):
+        out, state = self.run(frame.unsqueeze(1), state)
+        return out[:, 0], state
+
+
+class WindowLSTM(nn.Module):
+    """Base of the LSTMs whose head reads the LSTM outputs of the whole look_back window.
+
+    step(frame, window) feeds one frame and returns forward of the window of
+    the last look_back input frames it keeps. stream(frame, state) runs the
+    LSTM once per frame and keeps a ring of its last look_back outputs, it
+    matches forward for the first window from init_state() but afterwards the
+    LSTM keeps its state instead of restarting at every window.
+    """
+    hidden_size = 100
+
+    @property
+    def look_back(self):
+        return self.fc1.in_features // self.hidden_size
+
+    def init_state(self, batch_size, device='cpu'):
+        return ((torch.zeros(1, batch_size, self.hidden_size, device=device),
+                 torch.zeros(1, batch_size, self.hidden_size, device=device)),
+                torch.zeros(batch_size, self.look_back, self.hidden_size, device=device))
 
+    def init_window(self, batch_size, device='cpu'):
+        return torch.zeros(batch_size, self.look_back, self.input_size, device=device)
 
-class LSTMRegressorv2(nn.Module):
+    def forward(self, x, state=None):
+        if state is None:
+            state = self.init_state(x.shape[0], x.device)
+        out, _ = self.lstm_1(x, state[0])
+        return self.head(out.reshape(out.shape[0], -1))
+
+    def step(self, frame, window):
+        window = torch.cat([window[:, 1:], frame.unsqueeze(1)], dim=1)
+        return self(window), window
+
+    def stream(self, frame, state):
+        out, hidden = self.lstm_1(frame.unsqueeze(1), state[0])
+        outputs = torch.cat([state[1][:, 1:], out], dim=1)
+        return self.head(outputs.reshape(outputs.shape[0], -1)), (hidden, outputs)
+
+
+class LSTMRegressorv2(WindowLSTM):
     def __init__(self, input_size, output_size):
         super(LSTMRegressorv2, self).__init__()
         self.input_size = input_size
@@ -112,16 +176,8 @@ class LSTMRegressorv2(nn.Module):
         self.lstm_1 = nn.LSTM(self.input_size, 100, batch_first=True)
         self.fc1 = nn.Linear(1000, 256)
         self.fc2 = nn.Linear(256, output_size)
-        self.h1 = self.init_hidden(batch_size=Config['batch_size'], device='cuda:0')
 
-    def init_hidden(self, batch_size, device='cpu'):
-        return [(torch.zeros(1, batch_size, 100).to(device), torch.zeros(1, batch_size, 100).to(device))]
-
-    def forward(self, x, device='cpu'):
-        out, self.h1 = self.lstm_1(x, self.h1[0])
-        # print(out.shape)
-        out = out.reshape(out.shape[0], -1)
-        # print(out.shape)
+    def head(self, out):
         out = self.fc1(out)
         out = self.fc2(out)
         return out
@@ -147,7 +203,7 @@ class Classifier(nn.Module):
         return self.fc4(x)
 
 
-class LSTMClassifier(nn.Module):
+class LSTMClassifier(WindowLSTM):
     def __init__(self, input_size, output_size):
         super(LSTMClassifier, self).__init__()
         self.input_size = input_size
@@ -161,18 +217,36 @@ class LSTMClassifier(nn.Module):
         self.fc3 = nn.Linear(256, 64)
         self.bn4 = nn.BatchNorm1d(64)
         self.fc4 = nn.Linear(64, output_size)
-        self.h1 = self.init_hidden(batch_size=Config['batch_size'], device='cuda:0')
-
-    def init_hidden(self, batch_size, device='cpu'):
-        return (torch.zeros(1, batch_size, 100).to(device), torch.zeros(1, batch_size, 100).to(device))
 
-    def forward(self, x, device='cpu'):
-        out, self.h1 = self.lstm_1(x, self.h1)
-        #         print(out.shape)
-        out = out.reshape(out.shape[0], -1)
+    def head(self, out):
         out = nn.Tanh()(self.bn2(self.fc1(out)))
         out = nn.Tanh()(self.bn3(self.fc2(out)))
         out = nn.Tanh()(self.bn4(self.fc3(out)))
         out = self.fc4(out)
         #         print(out.shape)
-        return out
\ No newline at end of file
+        return out
+
+
+class ScaledModel(nn.Module):
+    """A model trained on MinMax scaled data that takes and returns raw units, for exporting one self-contained graph
+
+    Args-
+        model- Trained model
+        scale, min_- x * scale + min_ of the training scaler (scaler.min_, not data_min_) per input element, broadcast against the input
+        inv_scale, offset- Optional outputs * inv_scale + offset undoing the scaling of the labels per output
+    """
+    def __init__(self, model, scale, min_, inv_scale=None, offset=None):
+        super(ScaledModel, self).__init__()
+        self.model = model
+        self.register_buffer('scale', torch.as_tensor(scale, dtype=torch.float32))
+        self.register_buffer('min_', torch.as_tensor(min_, dtype=torch.float32))
+        self.rescale = inv_scale is not None
+        if self.rescale:
+            self.register_buffer('inv_scale', torch.as_tensor(inv_scale, dtype=torch.float32))
+            self.register_buffer('offset', torch.as_tensor(offset, dtype=torch.float32))
+
+    def forward(self, x):
+        out = self.model(torch.addcmul(self.min_, x, self.scale))
+        if self.rescale:
+            out = torch.addcmul(self.offset, out, self.inv_scale)
+        return out
@@ -0,0 +1,313 @@
+import torch
+import numpy as np
+
+import copy
+import json
+
+from model import Regressorv2, LSTMRegressor, Classifier
+from data import COLUMNS, OUTPUT_TYPES
+from features import relative_features
+from inference import inverse_scaler
+
+# Raw pose columns a client sends for every frame, the .iloc[:, 1:41] of a session CSV
+FRAME_COLUMNS = COLUMNS[:40]
+
+
+class RingBuffer:
+    """The last size rows of a session, readable oldest first as one contiguous array.
+
+    Every row is written twice, size rows apart, so window() is a plain slice
+    and a push never shifts the buffer.
+    """
+    def __init__(self, size, width):
+        self.size = size
+        self.data = np.zeros((2 * size, width), dtype=np.float32)
+        self.pos = 0
+        self.count = 0
+
+    def push(self, row):
+        self.data[self.pos] = row
+        self.data[self.pos + self.size] = row
+        self.pos = (self.pos + 1) % self.size
+        self.count += 1
+
+    @property
+    def full(self):
+        return self.count >= self.size
+
+    def window(self):
+        return self.data[self.pos:self.pos + self.size]
+
+
+class InputSpec:
+    """Which elements of the frame history make up one model input.
+
+    Args-
+        columns- Array-like of data.COLUMNS names, shaped like one model input
+        frames- Same shaped frame of every element, 0 is the oldest of the look_back frames
+        look_back- Frames of history the input spans
+        scaler_keys- Same shaped scaler.json entry of every element, defaults to columns
+    """
+    def __init__(self, columns, frames=None, look_back=1, scaler_keys=None):
+        self.columns = np.asarray(columns)
+        self.frames = np.zeros(self.columns.shape, dtype=np.int64) if frames is None else np.asarray(frames, dtype=np.int64)
+        self.look_back = look_back
+        self.scaler_keys = self.columns if scaler_keys is None else np.asarray(scaler_keys)
+        self.column_idx = np.array([COLUMNS.index(c) for c in self.columns.ravel()]).reshape(self.columns.shape)
+
+
+def frame_input(columns):
+    """Input of the columns of the newest frame, e.g. the Regressor and the typing classifiers"""
+    return InputSpec(columns)
+
+
+def window_input(columns, look_back):
+    """(look_back, len(columns)) input, e.g. the LSTMs"""
+    frames = np.repeat(np.arange(look_back)[:, None], len(columns), axis=1)
+    return InputSpec(np.tile(columns, (look_back, 1)), frames, look_back)
+
+
+def flat_window_input(groups, look_back):
+    """Flat input of every column group over look_back frames, group by group, as GestureCSVDataset builds it"""
+    columns = [c for group in groups for i in range(look_back) for c in group]
+    frames = [i for group in groups for i in range(look_back) for c in group]
+    # the wide gesture CSVs are scaled per frame column, e.g. relativeHandRPosx3
+    scaler_keys = [c + str(i) for group in groups for i in range(look_back) for c in group]
+    return InputSpec(columns, frames, look_back, scaler_keys)
+
+
+class Predictor:
+    """A trained model together with the frame pipeline of its training data.
+
+    Gathers its input from a frame history that already holds the derived
+    features, applies the scaler.json transform of its training run and turns
+    the outputs into inverse scaled values (regressors) or label names
+    (classifiers).
+
+    Args-
+        model- Trained model
+        scaler- Contents of the scaler.json of the training run
+        inputs- InputSpec of the model input
+        output_columns- Output columns of a regressor, inverse scaled with scaler
+        labels- Label names of a classifier by output index
+        last_step- The model returns an output per window frame, only the last one is kept
+        stream- Serve the model frame by frame through model.stream() with a hidden state per
+            session instead of rerunning windows, see LSTMRegressor
+        device- Device the model runs on
+    """
+    def __init__(self, model, scaler, inputs, output_columns=None, labels=None, last_step=False, stream=False, device='cpu'):
+        self.device = torch.device(device)
+        self.model = model.to(self.device).eval()
+        self.inputs = inputs
+        params = {param['type']: param for param in scaler['scalers']}
+        keys = inputs.scaler_keys.ravel()
+        self.scale = np.array([params[key]['scale'] for key in keys], dtype=np.float32).reshape(inputs.columns.shape)
+        self.min = np.array([params[key]['min'] for key in keys], dtype=np.float32).reshape(inputs.columns.shape)
+        self.output_columns = output_columns
+        if output_columns is not None:
+            self.inv_scale, self.offset = inverse_scaler(scaler, output_columns, self.device)
+        self.labels = labels
+        self.last_step = last_step
+        self.stream = stream
+
+    @property
+    def look_back(self):
+        return self.inputs.look_back
+
+    def signature(self):
+        """Equal for predictors whose inputs are the same elements scaled the same way"""
+        return (self.look_back, self.inputs.columns.shape, self.inputs.column_idx.tobytes(), self.inputs.frames.tobytes(),
+                self.scale.tobytes(), self.min.tobytes())
+
+    def gather(self, windows):
+        """Scaled model inputs (batch, *input shape) of frame histories (batch, frames, len(COLUMNS)), newest frame last"""
+        frames = windows.shape[1] - self.look_back + self.inputs.frames
+        return windows[:, frames, self.inputs.column_idx] * self.scale + self.min
+
+    def postprocess(self, outputs):
+        """Inverse scaled values, or label names of a classifier, of a batch of raw model outputs"""
+        if self.last_step:
+            outputs = outputs[:, -1]
+        if self.labels is not None:
+            return [self.labels[idx] for idx in outputs.argmax(dim=1).tolist()]
+        return torch.addcmul(self.offset, outputs, self.inv_scale).tolist()
+
+    def predict(self, windows):
+        """Outputs for a batch of frame histories (batch, >= look_back, len(COLUMNS))"""
+        with torch.inference_mode():
+            return self.postprocess(self.model(torch.from_numpy(self.gather(windows)).to(self.device)))
+
+
+def stacked_runner(models):
+    """Runs models of the same architecture on one input, as a single vmapped model when there are several"""
+    if len(models) == 1:
+        return lambda inputs: [models[0](inputs)]
+    params, buffers = torch.func.stack_module_state(models)
+    base = copy.deepcopy(models[0]).to('meta')
+
+    def call(params, buffers, inputs):
+        return torch.func.functional_call(base, (params, buffers), (inputs,))
+    run = torch.vmap(call, in_dims=(0, 0, None))
+    return lambda inputs: list(run(params, buffers, inputs))
+
+
+def cat_states(states):
+    """One batched state of per-session LSTM states, nested tuples of (layers, batch, hidden) tensors"""
+    if isinstance(states[0], tuple):
+        return tuple(cat_states(list(state)) for state in zip(*states))
+    return torch.cat(states, dim=1)
+
+
+def split_state(state, row):
+    """The state of row of a batched LSTM state"""
+    if isinstance(state, tuple):
+        return tuple(split_state(s, row) for s in state)
+    return state[:, row:row + 1].clone()
+
+
+class Session:
+    """Frame history of a headset session and the hidden states of its stream predictors"""
+    def __init__(self, look_back):
+        self.history = RingBuffer(look_back, len(COLUMNS))
+        self.states = {}
+
+
+class ServingGraph:
+    """Serves several Predictors from one frame history per session.
+
+    The derived features of a frame are computed once when it arrives. Per
+    batch, every distinct input signature is gathered and scaled once and
+    shared by all models reading it, and models of the same architecture on
+    the same input run as one stacked model. Stream predictors run once per
+    frame on the newest frame, carrying their hidden state in the Session.
+
+    Args-
+        predictors- Dict of name -> Predictor
+        device- Device the stacked models run on
+    """
+    def __init__(self, predictors, device='cpu'):
+        self.predictors = dict(predictors)
+        self.device = torch.device(device)
+        self.look_back = max(predictor.look_back for predictor in self.predictors.values())
+        self.streams = [name for name, predictor in self.predictors.items() if predictor.stream]
+        by_signature = {}
+        for name, predictor in self.predictors.items():
+            if predictor.stream:
+                continue
+            by_signature.setdefault(predictor.signature(), []).append(name)
+        self.groups = []
+        for names in by_signature.values():
+            by_architecture = {}
+            for name in names:
+                model = self.predictors[name].model
+                key = (type(model), tuple((k, tuple(v.shape), v.dtype) for k, v in model.state_dict().items()))
+                by_architecture.setdefault(key, []).append(name)
+            runners = [(group, stacked_runner([self.predictors[name].model for name in group]))
+                       for group in by_architecture.values()]
+            self.groups.append((self.predictors[names[0]], runners))
+
+    def new_session(self):
+        return Session(self.look_back)
+
+    def push(self, session, frame):
+        """Adds a raw frame to a session history, returns what predict() needs for the session
+
+        The frames of a session have to go through predict() in the order they were pushed.
+        """
+        session.history.push(relative_features.transform(np.asarray(frame, dtype=np.float32), FRAME_COLUMNS))
+        # copied, the next frame of the session may arrive before the batch runs
+        return session.history.window().copy(), session.history.count, session
+
+    def predict(self, items):
+        """Outputs of every model for a batch of push() results, None where a window is not full yet
+
+        Returns-
+            One dict of name -> output per item
+        """
+        windows = np.stack([window for window, _, _ in items])
+        counts = np.array([count for _, count, _ in items])
+        sessions = [session for _, _, session in items]
+        results = [dict.fromkeys(self.predictors) for _ in items]
+        with torch.inference_mode():
+            for name in self.streams:
+                predictor = self.predictors[name]
+                frames = torch.from_numpy(predictor.gather(windows)).to(self.device)
+                state = cat_states([session.states[name] if name in session.states else predictor.model.init_state(1, self.device)
+                                    for session in sessions])
+                outputs, state = predictor.model.stream(frames, state)
+                for row, (session, value) in enumerate(zip(sessions, predictor.postprocess(outputs))):
+                    session.states[name] = split_state(state, row)
+                    results[row][name] = value
+            for predictor, runners in self.groups:
+                ready = np.flatnonzero(counts >= predictor.look_back)
+                if len(ready) == 0:
+                    continue
+                inputs = torch.from_numpy(predictor.gather(windows[ready])).to(self.device)
+                for names, run in runners:
+                    for name, outputs in zip(names, run(inputs)):
+                        for row, value in zip(ready, self.predictors[name].postprocess(outputs)):
+                            results[row][name] = value
+        return results
+
+
+GESTURE_GROUPS = [
+    ['relativeHandRPosx', 'relativeHandRPosy', 'relativeHandRPosz'],
+    ['relativeHandLPosx', 'relativeHandLPosy', 'relativeHandLPosz'],
+    ['headRotx', 'headRoty', 'headRotz'],
+    ['handRRotx', 'handRRoty', 'handRRotz'],
+    ['handLRotx', 'handLRoty', 'handLRotz'],
+]
+GRAB_COLUMNS = ['headPosx', 'headPosy', 'headPosz', 'headRotQx', 'headRotQy', 'headRotQz', 'headRotQw',
+                'relativeHandRPosx', 'relativeHandRPosy', 'relativeHandRPosz', 'handRRotQx', 'handRRotQy', 'handRRotQz', 'handRRotQw',
+                'relativeHandLPosx', 'relativeHandLPosy', 'relativeHandLPosz', 'handLRotQx', 'handLRotQy', 'handLRotQz', 'handLRotQw',
+                'relativeTracker1Posx', 'relativeTracker1Posy', 'relativeTracker1Posz', 'tracker1RotQx', 'tracker1RotQy', 'tracker1RotQz', 'tracker1RotQw']
+NUMPAD_COLUMNS = ['relativeHandRPosx', 'relativeHandRPosy', 'relativeHandRPosz', 'relativeHandLPosx', 'relativeHandLPosy', 'relativeHandLPosz',
+                  'headRotx', 'headRoty', 'headRotz', 'handRRotx', 'handRRoty', 'handRRotz', 'handLRotx', 'handLRoty', 'handLRotz']
+TYPING_COLUMNS = {
+    'left': ['relativeHandLPosx', 'relativeHandLPosy', 'relativeHandLPosz', 'headRotx', 'headRoty', 'headRotz', 'handLRotx', 'handLRoty', 'handLRotz'],
+    'right': ['relativeHandRPosx', 'relativeHandRPosy', 'relativeHandRPosz', 'headRotx', 'headRoty', 'headRotz', 'handRRotx', 'handRRoty', 'handRRotz'],
+}
+
+
+def classifier(inputs):
+    # the number of classes comes from the checkpoint
+    return lambda state: Classifier(input_size=inputs.columns.size, output_size=state['fc4.weight'].shape[0])
+
+
+# name -> (model constructor called with the checkpoint state_dict, InputSpec, regressor output columns, last_step, stream)
+PREDICTORS = {
+    'regressor': (lambda state: Regressorv2(input_size=19, output_size=7), frame_input(OUTPUT_TYPES['relative'][0]),
+                  OUTPUT_TYPES['relative'][1], False, False),
+    'lstm': (lambda state: LSTMRegressor(input_size=19, output_size=7), window_input(OUTPUT_TYPES['relative'][0], 10),
+             OUTPUT_TYPES['relative'][1], True, False),
+    # one LSTM step per frame, the hidden state is never reset, see LSTMRegressor.stream
+    'lstm_stream': (lambda state: LSTMRegressor(input_size=19, output_size=7), frame_input(OUTPUT_TYPES['relative'][0]),
+                    OUTPUT_TYPES['relative'][1], False, True),
+    'gesture': (classifier(flat_window_input(GESTURE_GROUPS, 10)), flat_window_input(GESTURE_GROUPS, 10), None, False, False),
+    'grab': (classifier(frame_input(GRAB_COLUMNS)), frame_input(GRAB_COLUMNS), None, False, False),
+    'numpad': (classifier(frame_input(NUMPAD_COLUMNS)), frame_input(NUMPAD_COLUMNS), None, False, False),
+    'typing_left': (classifier(frame_input(TYPING_COLUMNS['left'])), frame_input(TYPING_COLUMNS['left']), None, False, False),
+    'typing_right': (classifier(frame_input(TYPING_COLUMNS['right'])), frame_input(TYPING_COLUMNS['right']), None, False, False),
+}
+
+
+def load_labels(path):
+    """Label names by class index from a labels.json written by the train_*_classifier.py scripts"""
+    with open(path, 'r') as f:
+        entries = next(iter(json.load(f).values()))
+    return [next(value for key, value in entry.items() if key != 'key') for entry in sorted(entries, key=lambda e: e['key'])]
+
+
+def load_predictor(kind, checkpoint, scaler_path, labels_path=None, device='cpu'):
+    """Predictor of a PREDICTORS entry with the weights of checkpoint, the scaler of scaler_path and,
+    for classifiers, the labels of labels_path (class indices when it is None)"""
+    make_model, inputs, output_columns, last_step, stream = PREDICTORS[kind]
+    state = torch.load(checkpoint, map_location=device)
+    model = make_model(state)
+    model.load_state_dict(state)
+    with open(scaler_path, 'r') as f:
+        scaler = json.load(f)
+    labels = None
+    if output_columns is None:
+        labels = load_labels(labels_path) if labels_path is not None else list(range(model.output_size))
+    return Predictor(model, scaler, inputs, output_columns, labels, last_step, stream, device)
@@ -0,0 +1,223 @@
+import torch
+import numpy as np
+
+import json
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import Config
+from predictor import load_predictor, ServingGraph, FRAME_COLUMNS
+
+# Protocol, one JSON object per line over TCP (one per datagram over UDP):
+#   request  {"seq": <any>, "frame": [<40 raw pose values, predictor.FRAME_COLUMNS>]}
+#   response {"seq": <same>, "predictions": {<model name>: <output values or label> or null while its look_back window fills up}}
+# A malformed request is answered with {"seq": <same or null>, "error": <message>} over TCP and dropped over UDP.
+# A TCP connection is one session, over UDP every client address is one session until it idles for
+# serve_session_timeout_s.
+
+
+class MicroBatcher:
+    """Coalesces the frames of concurrent sessions into batches for a ServingGraph.
+
+    A batch runs once max_batch inputs are waiting or max_delay seconds after
+    its first input arrived, whichever comes first. Batches run one at a time
+    on a worker thread, the event loop keeps serving the sockets meanwhile.
+
+    Args-
+        graph- ServingGraph the batches run through
+        max_batch- Largest batch
+        max_delay- Longest time in seconds an input waits for others
+    """
+    def __init__(self, graph, max_batch=Config['serve_max_batch'], max_delay=Config['serve_max_delay_ms'] / 1000):
+        self.graph = graph
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue()
+        # one thread, the stream states of a session are updated batch after batch
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='inference')
+
+    async def predict(self, inputs):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue.put_nowait((inputs, future, loop.time()))
+        return await future
+
+    async def collect(self):
+        batch = [await self.queue.get()]
+        # counted from the arrival of the first input, it may have waited for the previous batch
+        deadline = batch[0][2] + self.max_delay
+        while len(batch) < self.max_batch:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        while True:
+            batch = await self.collect()
+            try:
+                outputs = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, self.graph.predict, [inputs for inputs, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future, _), output in zip(batch, outputs):
+                if not future.done():
+                    future.set_result(output)
+
+
+class InferenceServer:
+    """Serves every model of a ServingGraph to headset sessions over TCP and UDP on localhost"""
+    def __init__(self, graph, max_batch=Config['serve_max_batch'], max_delay=Config['serve_max_delay_ms'] / 1000,
+                 session_timeout=Config['serve_session_timeout_s']):
+        self.graph = graph
+        self.batcher = MicroBatcher(graph, max_batch, max_delay)
+        self.session_timeout = session_timeout
+        self.sessions = {}
+        self.last_seen = {}
+
+    def parse(self, message):
+        """seq and frame of a request, ValueError when it is not an object with a frame of FRAME_COLUMNS numbers"""
+        request = json.loads(message)
+        if not isinstance(request, dict) or 'frame' not in request:
+            raise ValueError('A request is a JSON object with a "frame"')
+        try:
+            frame = np.asarray(request['frame'], dtype=np.float32)
+        except (TypeError, ValueError):
+            raise ValueError('The frame has to be a list of numbers')
+        if frame.shape != (len(FRAME_COLUMNS),):
+            raise ValueError(f'The frame has to hold {len(FRAME_COLUMNS)} values, got shape {frame.shape}')
+        return request.get('seq'), frame
+
+    async def handle_frame(self, session, message):
+        seq, frame = self.parse(message)
+        state = self.sessions.get(session)
+        if state is None:
+            state = self.sessions[session] = self.graph.new_session()
+        self.last_seen[session] = asyncio.get_running_loop().time()
+        predictions = await self.batcher.predict(self.graph.push(state, frame))
+        return json.dumps({'seq': seq, 'predictions': predictions}).encode('utf-8')
+
+    def close_session(self, session):
+        self.sessions.pop(session, None)
+        self.last_seen.pop(session, None)
+
+    async def evict_idle(self):
+        """Closes UDP sessions that sent nothing for session_timeout seconds, a datagram has no end of session"""
+        while True:
+            await asyncio.sleep(self.session_timeout / 2)
+            now = asyncio.get_running_loop().time()
+            for session, seen in list(self.last_seen.items()):
+                if session[0] == 'udp' and now - seen > self.session_timeout:
+                    self.close_session(session)
+
+    async def handle_connection(self, reader, writer):
+        session = ('tcp', writer.get_extra_info('peername'))
+        try:
+            # frames of one session are answered in order
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    response = await self.handle_frame(session, line)
+                except ValueError as e:
+                    # a malformed frame is answered, the session goes on
+                    response = json.dumps({'seq': request_seq(line), 'error': str(e)}).encode('utf-8')
+                writer.write(response + b'\n')
+                await writer.drain()
+        except ConnectionError as e:
+            print(f'Session {session[1]} closed: {e!r}')
+        finally:
+            self.close_session(session)
+            writer.close()
+
+    async def serve(self, host=Config['serve_host'], port=Config['serve_port'], udp_port=None):
+        loop = asyncio.get_running_loop()
+        batcher = asyncio.create_task(self.batcher.run())
+        evictor = asyncio.create_task(self.evict_idle())
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        transport = None
+        if udp_port is not None:
+            transport, _ = await loop.create_datagram_endpoint(lambda: DatagramSessions(self), local_addr=(host, udp_port))
+        print(f'Serving on tcp://{host}:{port}' + (f' and udp://{host}:{udp_port}' if udp_port is not None else ''))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if transport is not None:
+                transport.close()
+            batcher.cancel()
+            evictor.cancel()
+
+
+def request_seq(message):
+    """seq of a request that could not be handled, None when it has none"""
+    try:
+        request = json.loads(message)
+    except ValueError:
+        return None
+    return request.get('seq') if isinstance(request, dict) else None
+
+
+def load_graph(specs, device='cpu'):
+    """ServingGraph of --model specs, NAME=KIND,CHECKPOINT,SCALER[,LABELS] each"""
+    predictors = {}
+    for spec in specs:
+        name, paths = spec.split('=', 1)
+        predictors[name] = load_predictor(*paths.split(','), device=device)
+    return ServingGraph(predictors, device)
+
+
+class DatagramSessions(asyncio.DatagramProtocol):
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        # datagrams of an address are handled in order, a frame waits for the previous one of its session
+        previous = self.pending.get(addr)
+        self.pending[addr] = asyncio.ensure_future(self.reply(data, addr, previous))
+
+    async def reply(self, data, addr, previous):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            self.transport.sendto(await self.server.handle_frame(('udp', addr), data), addr)
+        except ValueError as e:
+            print(f'Dropped datagram from {addr}: {e!r}')
+        if self.pending.get(addr) is asyncio.current_task():
+            del self.pending[addr]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Real-time inference server of the waist tracker, gesture, grab and typing models for headset sessions on localhost')
+    parser.add_argument('--model', action='append', required=True, metavar='NAME=KIND,CHECKPOINT,SCALER[,LABELS]',
+                        help='a model to serve, KIND is a predictor.PREDICTORS entry, e.g. waist=regressor,model_final.pth,scaler.json; repeat for every model')
+    parser.add_argument('--host', default=Config['serve_host'])
+    parser.add_argument('--port', type=int, default=Config['serve_port'])
+    parser.add_argument('--udp', action='store_true', help='also serve UDP on port+1')
+    parser.add_argument('--max_batch', type=int, default=Config['serve_max_batch'])
+    parser.add_argument('--max_delay_ms', type=float, default=Config['serve_max_delay_ms'])
+    parser.add_argument('--session_timeout', type=float, default=Config['serve_session_timeout_s'],
+                        help='seconds after which an idle UDP session is forgotten')
+    parser.add_argument('--threads', type=int, default=1, help='torch threads, small batches are fastest on one')
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.threads)
+    server = InferenceServer(load_graph(args.model), args.max_batch, args.max_delay_ms / 1000, args.session_timeout)
+    asyncio.run(server.serve(args.host, args.port, args.port + 1 if args.udp else None))
@@ -0,0 +1,136 @@
+import os
+import json
+
+import numpy as np
+from sklearn.preprocessing import MinMaxScaler
+
+from utils import Config
+from cache import cache_dir, signature, iter_session
+from features import relative_features
+
+# Bumped whenever the sidecar layout or the columns it covers change
+STATS_VERSION = 1
+
+
+def stats_path(path):
+    return os.path.join(cache_dir(path), 'stats.json')
+
+
+def empty_stats(columns):
+    n = len(columns)
+    return {
+        'columns': list(columns),
+        'count': 0,
+        'min': np.full(n, np.inf),
+        'max': np.full(n, -np.inf),
+        'sum': np.zeros(n),
+        'sumsq': np.zeros(n)
+    }
+
+
+def update_stats(stats, data):
+    """Folds a (frames, columns) block into stats in place"""
+    data = np.asarray(data, dtype=np.float64)
+    if len(data) == 0:
+        return stats
+    stats['count'] += len(data)
+    np.minimum(stats['min'], np.nanmin(data, axis=0), out=stats['min'])
+    np.maximum(stats['max'], np.nanmax(data, axis=0), out=stats['max'])
+    stats['sum'] += np.nansum(data, axis=0)
+    stats['sumsq'] += np.nansum(np.square(data), axis=0)
+    return stats
+
+
+def merge_stats(all_stats):
+    """Combines the stats of several sessions into the stats of their concatenation"""
+    merged = empty_stats(all_stats[0]['columns'])
+    for stats in all_stats:
+        if stats['columns'] != merged['columns']:
+            raise ValueError('Cannot merge stats of different columns')
+        if stats['count'] == 0:
+            # an empty session has min inf and max -inf, it would turn the scale inf or NaN
+            continue
+        merged['count'] += stats['count']
+        np.minimum(merged['min'], stats['min'], out=merged['min'])
+        np.maximum(merged['max'], stats['max'], out=merged['max'])
+        merged['sum'] += stats['sum']
+        merged['sumsq'] += stats['sumsq']
+    return merged
+
+
+def load_stats(path):
+    """Returns the sidecar stats of a session, or None if they are missing or stale"""
+    try:
+        with open(stats_path(path), 'r') as f:
+            sidecar = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if sidecar.get('stats_version') != STATS_VERSION:
+        return None
+    for key, value in signature(path).items():
+        if sidecar.get(key) != value:
+            return None
+    stats = {key: sidecar[key] for key in ('columns', 'count')}
+    for key in ('min', 'max', 'sum', 'sumsq'):
+        stats[key] = np.asarray(sidecar[key], dtype=np.float64)
+    return stats
+
+
+def save_stats(path, stats, sig):
+    directory = cache_dir(path)
+    os.makedirs(directory, exist_ok=True)
+    sidecar = dict(sig, stats_version=STATS_VERSION, columns=stats['columns'], count=stats['count'])
+    for key in ('min', 'max', 'sum', 'sumsq'):
+        sidecar[key] = stats[key].tolist()
+    tmp_path = os.path.join(directory, f'stats.json.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(sidecar, f)
+    os.replace(tmp_path, stats_path(path))
+
+
+def session_stats(path, csv_data=None):
+    """Per-column min, max, count, sum and sumsq of the 40 pose columns and 9 relative features of a session.
+
+    The stats are kept in a sidecar next to the session's columnar cache and are
+    only recomputed when the CSV changes. A changed CSV is read again in full, rows
+    appended to a recording are not folded into its previous stats.
+
+    Args-
+        path- Path of the session CSV
+        csv_data- The session already read with relative_features applied, used
+            instead of reading the session again when the sidecar is stale
+
+    Returns-
+        A dict with the column names, the row count and one array per statistic
+    """
+    stats = load_stats(path)
+    if stats is not None:
+        return stats
+    # taken before reading so that a CSV rewritten meanwhile invalidates the sidecar
+    sig = signature(path)
+    if csv_data is not None:
+        stats = update_stats(empty_stats(csv_data.columns), csv_data.to_numpy(dtype=np.float64))
+    else:
+        stats = None
+        for chunk in iter_session(path, columns=slice(1,41), chunk_rows=Config['stream_chunk_rows']):
+            chunk = relative_features(chunk)
+            if stats is None:
+                stats = empty_stats(chunk.columns)
+            update_stats(stats, chunk.to_numpy(dtype=np.float64))
+    save_stats(path, stats, sig)
+    return stats
+
+
+def scaler_from_stats(stats, feature_range=(0, 1)):
+    """A MinMaxScaler fitted from merged stats, equal to fitting it on all the rows"""
+    if stats['count'] == 0:
+        raise ValueError('Cannot fit a scaler without any rows')
+    scaler = MinMaxScaler(feature_range=feature_range)
+    scaler.partial_fit(np.stack([stats['min'], stats['max']]))
+    scaler.n_samples_seen_ = stats['count']
+    return scaler
+
+
+def fit_scaler(paths, feature_range=(0, 1)):
+    """Fits a MinMaxScaler over several sessions from their sidecars, only stale sessions are read"""
+    return scaler_from_stats(merge_stats([session_stats(path) for path in paths]), feature_range)
@@ -0,0 +1,287 @@
+import torch
+import numpy as np
+
+import os
+import json
+import math
+import queue
+import random
+import argparse
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+from utils import Config
+from model import Regressor, Regressorv2, SVMRegressor
+from stats import scaler_from_stats
+from data import CSVDataset, LSTMCSVDataset, collate_batch, make_loader, split_dataset
+from trainer import Trainer
+from budget import BudgetController, make_scheduler
+from checkpoint import load_training_state
+from metrics import R2Score, MeanAbsoluteError
+from train_hacklstm import flatten_windows
+
+# Every list is sampled uniformly, ('log', low, high) log-uniformly and ('uniform', low, high) uniformly.
+# look_back None trains on single frames (train.py), otherwise on flattened windows (train_hacklstm.py)
+SEARCH_SPACE = {
+    'lr': ('log', 1e-4, 1e-2),
+    'batch_size': [64, 128, 256, 512],
+    'data_type': ['euler', 'quaternion', 'both', 'relative'],
+    'look_back': [None, 5, 10, 20],
+    'step_value': [1, 2],
+    'model': ['Regressor', 'Regressorv2', 'SVMRegressor'],
+}
+
+MODELS = {'Regressor': Regressor, 'Regressorv2': Regressorv2, 'SVMRegressor': SVMRegressor}
+
+# State of a sweep worker process, set once by init_worker
+WORKER = {}
+
+
+def sample_config(space, rng):
+    config = {}
+    for key, values in space.items():
+        if isinstance(values, (list, tuple)) and len(values) == 3 and values[0] in ('log', 'uniform'):
+            low, high = values[1], values[2]
+            config[key] = math.exp(rng.uniform(math.log(low), math.log(high))) if values[0] == 'log' else rng.uniform(low, high)
+        else:
+            config[key] = rng.choice(list(values))
+    return config
+
+
+def available_cores():
+    """The cores this process may run on"""
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+
+
+def core_sets(num_workers):
+    """Splits the cores this process may run on into num_workers disjoint groups"""
+    cores = available_cores()
+    if not 1 <= num_workers <= len(cores):
+        raise ValueError(f'Cannot split {len(cores)} cores into {num_workers} disjoint groups')
+    size = len(cores) // num_workers
+    return [cores[idx * size:(idx + 1) * size] for idx in range(num_workers)]
+
+
+def feature_range(config):
+    """Scaling of a trial's frames, (0,1) as CSVDataset for single frames and (-1,1) as LSTMCSVDataset for windows"""
+    return (0, 1) if config['look_back'] is None else (-1, 1)
+
+
+def share_frames(frames):
+    """Copies an array into a new shared memory block, returns the block and the spec to attach to it"""
+    block = shared_memory.SharedMemory(create=True, size=frames.nbytes)
+    np.ndarray(frames.shape, dtype=frames.dtype, buffer=block.buf)[:] = frames
+    return block, (block.name, frames.shape, frames.dtype.str)
+
+
+def init_worker(frames_specs, session_lengths, cores, config):
+    cores = cores.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    Config.update(config)
+    WORKER['blocks'] = {}
+    WORKER['frames'] = {}
+    for scaling, (name, shape, dtype) in frames_specs.items():
+        WORKER['blocks'][scaling] = shared_memory.SharedMemory(name=name)
+        WORKER['frames'][scaling] = np.ndarray(shape, dtype=dtype, buffer=WORKER['blocks'][scaling].buf)
+    WORKER['session_lengths'] = session_lengths
+
+
+def run_trial(trial_id, config, num_epochs, root, max_epochs, seed):
+    """Trains a trial in a worker until num_epochs, continuing from its last rung
+
+    Args-
+        trial_id- Index of the trial, its run goes to <root>/trial_<trial_id>
+        config- Sampled hyperparameters, see SEARCH_SPACE
+        num_epochs- Total number of epochs the trial has trained after this call
+        root- Directory of the sweep
+        max_epochs- Epochs of the last rung, the length of the lr schedule
+        seed- Seed of the train/valid split, the same for every trial
+
+    Returns-
+        trial_id and the validation results of the best epoch so far
+    """
+    Config['model_path'] = os.path.join(root, f'trial_{trial_id}')
+    Config['batch_size'] = config['batch_size']
+    os.makedirs(os.path.join(Config['model_path'], 'checkpoints'), exist_ok=True)
+
+    frames = WORKER['frames'][feature_range(config)]
+    if config['look_back'] is None:
+        dataset = CSVDataset.from_frames(frames, config['data_type'])
+        prepare_batch = None
+        input_size = len(dataset.input_idx)
+    else:
+        dataset = LSTMCSVDataset.from_frames(frames, WORKER['session_lengths'], config['data_type'],
+                                             config['look_back'], config['step_value'])
+        prepare_batch = flatten_windows
+        input_size = len(dataset.input_idx) * len(dataset.frame_offsets)
+
+    resume = load_training_state()
+    torch.manual_seed(seed)
+    train_dataset, valid_dataset = split_dataset(dataset, 0.8, resume)
+    dataloaders = {
+        'train': make_loader(train_dataset, shuffle=True, device='cpu', collate_fn=collate_batch),
+        'valid': make_loader(valid_dataset, shuffle=False, device='cpu', collate_fn=collate_batch)
+    }
+
+    model = MODELS[config['model']](input_size=input_size, output_size=len(dataset.label_idx))
+    optimizer = torch.optim.SGD(model.parameters(), lr=config['lr'], weight_decay=Config['weight_decay'])
+    scheduler = make_scheduler(optimizer, Config['lr_schedule'], max_epochs, len(dataloaders['train']), 'max')
+    budget = BudgetController('r2', 'max', patience=Config['early_stopping_patience'],
+                              min_delta=Config['early_stopping_min_delta'], max_time=None, target=Config['target_loss'])
+    trainer = Trainer(model, torch.nn.MSELoss(reduction='sum'), optimizer, 'cpu',
+                      metrics={'r2': R2Score(), 'mae': MeanAbsoluteError()}, prepare_batch=prepare_batch,
+                      monitor='r2', mode='max', scheduler=scheduler, budget=budget)
+    return trial_id, trainer.fit(dataloaders, num_epochs=num_epochs, resume=resume)
+
+
+class ASHA:
+    """Asynchronous successive halving over a fixed list of trials.
+
+    Rung k trains a trial up to min_epochs * eta^k epochs (capped at
+    max_epochs). Whenever a worker is free, the best not yet promoted trial
+    among the top 1/eta of the highest possible rung is promoted and resumed,
+    otherwise a new trial starts at rung 0. Losing trials are never resumed.
+
+    Args-
+        num_trials- Number of sampled trials
+        min_epochs- Epochs of the first rung
+        max_epochs- Epochs of the last rung
+        eta- Fraction 1/eta of every rung that is promoted
+    """
+    def __init__(self, num_trials, min_epochs, max_epochs, eta=3):
+        self.epochs = [min_epochs]
+        while self.epochs[-1] < max_epochs:
+            self.epochs.append(min(self.epochs[-1] * eta, max_epochs))
+        self.eta = eta
+        self.rungs = [{} for _ in self.epochs]
+        self.promoted = [set() for _ in self.epochs]
+        self.pending = list(range(num_trials))
+
+    def next_job(self):
+        """(trial_id, rung) to run next, or None when nothing can run before a result comes back"""
+        for rung in reversed(range(len(self.epochs) - 1)):
+            scores = self.rungs[rung]
+            ranked = sorted(scores, key=scores.get, reverse=True)[:len(scores) // self.eta]
+            for trial_id in ranked:
+                if trial_id not in self.promoted[rung]:
+                    self.promoted[rung].add(trial_id)
+                    return trial_id, rung + 1
+        if self.pending:
+            return self.pending.pop(0), 0
+        return None
+
+    def report(self, trial_id, rung, score):
+        self.rungs[rung][trial_id] = score
+
+
+def write_report(path, space, trials, asha):
+    report = {
+        'space': space,
+        'rung_epochs': asha.epochs,
+        'trials': trials,
+        'best': max(trials, key=lambda t: t['score'] if t['score'] is not None else -math.inf)
+    }
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(report, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def sweep(root, space=SEARCH_SPACE, num_trials=27, num_workers=1, min_epochs=5, max_epochs=135, eta=3, seed=0):
+    """Runs num_trials sampled configs of space with ASHA on a process pool pinned to disjoint core sets
+
+    The frames of Config['dataset_path'] are loaded once, scaled once per feature_range
+    the trials need and shared with every worker through shared memory, each trial
+    only builds its index over them.
+    Progress goes to <root>/sweep.json after every finished rung.
+
+    Returns-
+        The trial list with the config, the best validation results per rung and the final score
+    """
+    os.makedirs(root, exist_ok=True)
+    if num_workers > len(available_cores()):
+        print(f'Only {len(available_cores())} cores available, running {len(available_cores())} workers instead of {num_workers}')
+        num_workers = len(available_cores())
+    rng = random.Random(seed)
+    trials = [{'id': idx, 'config': sample_config(space, rng), 'rungs': {}, 'score': None} for idx in range(num_trials)]
+
+    dataset = CSVDataset(root_path=Config['dataset_path'])
+    blocks, frames_specs = [], {}
+    try:
+        for scaling in sorted({feature_range(trial['config']) for trial in trials}):
+            scaler = scaler_from_stats(dataset.stats, feature_range=scaling)
+            block, frames_specs[scaling] = share_frames(scaler.transform(dataset.data).astype(np.float32))
+            blocks.append(block)
+    except BaseException:
+        for block in blocks:
+            block.close()
+            block.unlink()
+        raise
+    session_lengths = dataset.session_lengths
+    del dataset
+
+    context = mp.get_context('spawn')
+    cores = context.Queue()
+    for core_set in core_sets(num_workers):
+        cores.put(core_set)
+    # trials read the shared frames directly, DataLoader workers would oversubscribe the pinned cores
+    worker_config = dict(Config)
+    worker_config.update(num_workers=0, device_loader=False)
+
+    asha = ASHA(num_trials, min_epochs, max_epochs, eta)
+    done = queue.Queue()
+    running = 0
+    try:
+        with context.Pool(num_workers, initializer=init_worker,
+                          initargs=(frames_specs, session_lengths, cores, worker_config)) as pool:
+            while True:
+                while running < num_workers:
+                    job = asha.next_job()
+                    if job is None:
+                        break
+                    trial_id, rung = job
+                    pool.apply_async(run_trial, (trial_id, trials[trial_id]['config'], asha.epochs[rung], root, max_epochs, seed),
+                                     callback=lambda result, rung=rung: done.put((rung, result)),
+                                     error_callback=lambda error: done.put((None, error)))
+                    running += 1
+                if running == 0:
+                    break
+                rung, result = done.get()
+                running -= 1
+                if rung is None:
+                    raise result
+                trial_id, results = result
+                asha.report(trial_id, rung, results['r2'])
+                trials[trial_id]['rungs'][asha.epochs[rung]] = results
+                trials[trial_id]['score'] = results['r2']
+                print(f'Trial {trial_id} rung {rung} ({asha.epochs[rung]} epochs): r2 {results["r2"]:.4f} {trials[trial_id]["config"]}')
+                write_report(os.path.join(root, 'sweep.json'), space, trials, asha)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return trials
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Hyperparameter sweep of the regressors with asynchronous successive halving')
+    parser.add_argument('--space', default=None, help='JSON file with a search space, defaults to SEARCH_SPACE')
+    parser.add_argument('--trials', type=int, default=27)
+    parser.add_argument('--workers', type=int, default=max(1, len(available_cores()) // 2),
+                        help='trials run concurrently, each pinned to its share of the cores')
+    parser.add_argument('--min_epochs', type=int, default=5)
+    parser.add_argument('--max_epochs', type=int, default=135)
+    parser.add_argument('--eta', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=os.path.join(Config['model_path'], 'sweep'))
+    args = parser.parse_args()
+
+    space = SEARCH_SPACE
+    if args.space is not None:
+        with open(args.space, 'r') as f:
+            space = json.load(f)
+    trials = sweep(args.out, space, args.trials, args.workers, args.min_epochs, args.max_epochs, args.eta, args.seed)
+    best = max(trials, key=lambda t: t['score'] if t['score'] is not None else -math.inf)
+    print('Best trial', best['id'], best['score'], best['config'])
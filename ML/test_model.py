@@ -0,0 +1,56 @@
+import torch
+import pytest
+
+from model import LSTMRegressor, LSTMRegressorv2, LSTMClassifier
+
+FRAMES = 25
+
+
+def last_output(model, window):
+    out = model(window)
+    return out[:, -1] if isinstance(model, LSTMRegressor) else out
+
+
+@pytest.mark.parametrize('make_model', [lambda: LSTMRegressor(19, 7), lambda: LSTMRegressorv2(19, 7),
+                                        lambda: LSTMClassifier(15, 4)])
+def test_step_matches_window_mode(make_model):
+    torch.manual_seed(0)
+    model = make_model().eval()
+    frames = torch.randn(3, FRAMES, model.input_size)
+    window = model.init_window(3)
+    with torch.no_grad():
+        for t in range(FRAMES):
+            out, window = model.step(frames[:, t], window)
+            if t + 1 >= model.look_back:
+                expected = last_output(model, frames[:, t + 1 - model.look_back:t + 1])
+                torch.testing.assert_close(out, expected)
+
+
+@pytest.mark.parametrize('make_model', [lambda: LSTMRegressor(19, 7), lambda: LSTMRegressorv2(19, 7),
+                                        lambda: LSTMClassifier(15, 4)])
+def test_stream_matches_first_window(make_model):
+    torch.manual_seed(0)
+    model = make_model().eval()
+    frames = torch.randn(3, model.look_back, model.input_size)
+    state = model.init_state(3)
+    with torch.no_grad():
+        for t in range(model.look_back):
+            out, state = model.stream(frames[:, t], state)
+        torch.testing.assert_close(out, last_output(model, frames))
+
+
+@pytest.mark.parametrize('make_model', [lambda: LSTMRegressor(19, 7), lambda: LSTMRegressorv2(19, 7),
+                                        lambda: LSTMClassifier(15, 4)])
+def test_onnx_export_declares_dynamic_axes(make_model, tmp_path):
+    pytest.importorskip('onnx')
+    from checkpoint import export_onnx, declared_shapes
+    model = make_model().eval()
+    path = str(tmp_path / 'model.onnx')
+    export_onnx(model, torch.zeros(1, model.look_back, model.input_size), path)
+    shapes = declared_shapes(path)
+    frames = 'frames' if isinstance(model, LSTMRegressor) else model.look_back
+    assert shapes['input'] == ['batch', frames, model.input_size]
+    if isinstance(model, LSTMRegressor):
+        assert shapes['output'] == ['batch', 'frames', model.output_size]
+    else:
+        assert shapes['output'] == ['batch', model.output_size]
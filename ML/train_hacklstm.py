@@ -1,98 +1,26 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.utils.tensorboard import SummaryWriter
 
-import copy 
-from tqdm import tqdm
 import os
 import json
 
 from utils import Config
 from model import Regressor, SVMRegressor
-from data import CSVDataset, LSTMCSVDataset
+from data import CSVDataset, LSTMCSVDataset, collate_batch, make_loader, split_dataset
+from trainer import Trainer, training_arguments
+from checkpoint import load_training_state
+from metrics import R2Score, MeanAbsoluteError
 
-def train(dataloader, dataset_sizes, model, criterion, optimizer, device, num_epochs=Config['num_epochs'], batch_size=Config['batch_size']):
-
-    model.to(device)
-
-    best_loss = 100.0
-    best_wts = copy.deepcopy(model.state_dict())
-    dummy_input = None
-
-    if Config['tensorboard_log']:
-        writer = SummaryWriter(Config['model_path'])
-    
-    for epoch in range(num_epochs):
-        for phase in ['train', 'valid']:
-            if phase=='train':
-                model.train()
-            else:
-                model.eval()
-            
-            running_loss = 0.0
-
-            for inputs, labels in tqdm(dataloader[phase]):
-                with torch.set_grad_enabled(True):
-
-                    optimizer.zero_grad()
-                    inputs = torch.reshape(inputs.to(device), (inputs.shape[0], inputs.shape[1]*inputs.shape[2]))
-                    labels = labels.to(device)[:,-1]
-                    if dummy_input is None:
-                        dummy_input = inputs[0]
-
-                    outputs = model(inputs)
-                    loss = criterion(outputs, labels)
-                    # print('Predicted: ', outputs )
-                    # print('Expected: ', labels)
-                    if Config['use_cuda']:
-                        l2_regularization = torch.tensor(0.).cuda()
-                    else:
-                        l2_regularization = torch.tensor(0.)
-                    
-                    for param in model.parameters():
-                        l2_regularization += torch.norm(param, 2)**2
-
-                    loss += 1e-5 * l2_regularization
-
-                    if phase =='train':
-                        loss.backward()
-                        optimizer.step()
-                    running_loss += loss.item()*inputs.size(0)
-            epoch_loss = running_loss/dataset_sizes[phase]
-            print(f'Epoch {epoch} Loss: {loss:.4f}')
-            if epoch_loss < best_loss and phase=='valid':
-                best_wts = copy.deepcopy(model.state_dict())
-            writer.add_scalar(phase+'_loss', epoch_loss, global_step=epoch)
-        if (epoch+1)%5==0:
-            torch.onnx.export(model,
-                      dummy_input,
-                      os.path.join(
-                            Config['model_path'],
-                            f'checkpoints/model_{epoch}.onnx'
-                        ),
-                      export_params=True
-                      )
-    print('Training ended')
-    torch.save(
-        best_wts,
-        os.path.join(
-            Config['model_path'],
-            'checkpoints/model_final.pth'
-        )
-    )
-    model.load_state_dict(best_wts)
-    torch.onnx.export(model,
-                      dummy_input,
-                      os.path.join(
-                            Config['model_path'],
-                            'checkpoints/model_final.onnx'
-                      ),
-                      export_params=True
-                      )
+def flatten_windows(inputs, labels):
+    # the whole window is fed to the Regressor as one flat vector, the label is the one of the last frame
+    return inputs.reshape(inputs.shape[0], -1), labels[:, -1]
 
 
 if __name__ == '__main__':
+    args = training_arguments().parse_args()
+    resume = load_training_state() if args.resume else None
+
     os.makedirs(Config['model_path'], exist_ok=True)
     os.makedirs(os.path.join(Config['model_path'],'logs'),exist_ok=True)
     os.makedirs(os.path.join(Config['model_path'],'checkpoints'),exist_ok=True)
@@ -178,41 +106,20 @@ if __name__ == '__main__':
 
     device = torch.device('cuda:0' if torch.cuda.is_available() and Config['use_cuda'] else 'cpu')
 
-    optimizer = torch.optim.SGD(model.parameters(), lr=Config['lr']) #rmsprop, adam
+    optimizer = torch.optim.SGD(model.parameters(), lr=Config['lr'], weight_decay=Config['weight_decay']) #rmsprop, adam
 
     criterion = torch.nn.MSELoss(reduction='sum')
 
-    ratio = [int(len(dataset)*0.8), len(dataset)-int(len(dataset)*0.8)]
-    train_dataset, valid_dataset = torch.utils.data.random_split(dataset, ratio)
+    train_dataset, valid_dataset = split_dataset(dataset, 0.8, resume)
 
-    train_loader = torch.utils.data.DataLoader(
-                        train_dataset,
-                        batch_size = Config['batch_size'],
-                        shuffle=True,
-                        num_workers = Config['num_workers']
-                    )
+    train_loader = make_loader(train_dataset, shuffle=True, device=device, collate_fn=collate_batch)
 
-    valid_loader = torch.utils.data.DataLoader(
-                        valid_dataset,
-                        batch_size = Config['batch_size'],
-                        shuffle=False,
-                        num_workers = Config['num_workers']
-                    )
+    valid_loader = make_loader(valid_dataset, shuffle=False, device=device, collate_fn=collate_batch)
     dataloaders = {
         'train' : train_loader,
         'valid' : valid_loader
     }
 
-    dataset_sizes = {
-        'train' : len(train_dataset),
-        'valid' : len(valid_dataset)
-    }
-
-    train(
-        dataloaders, 
-        dataset_sizes,
-        model,
-        criterion,
-        optimizer,
-        device
-        )
\ No newline at end of file
+    trainer = Trainer(model, criterion, optimizer, device, metrics={'r2': R2Score(), 'mae': MeanAbsoluteError()},
+                      prepare_batch=flatten_windows)
+    trainer.fit(dataloaders, resume=resume)
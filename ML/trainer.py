@@ -0,0 +1,271 @@
+import torch
+from torch.utils.tensorboard import SummaryWriter
+
+import os
+import argparse
+from datetime import datetime
+from tqdm import tqdm
+
+from utils import Config
+from budget import BudgetController, make_scheduler, steps_per_batch, step_scheduler
+from checkpoint import CheckpointStore, CheckpointWriter, snapshot, to_cpu, rng_state, set_rng_state, training_state_path
+
+
+class Trainer:
+    """Training loop shared by every train_*.py script.
+
+    Losses and metrics are accumulated on device and read once per epoch.
+    Validation runs under torch.no_grad. The L2 penalty the scripts used to add
+    to the loss is the optimizer's weight_decay (Config['weight_decay']).
+    Checkpoints are written by a background CheckpointWriter into a CheckpointStore,
+    and the full training state every resume_every epochs (and after the last one)
+    into resume.pth so that a run can be continued with fit(resume=load_training_state(name)). A
+    BudgetController stops training early on a plateau or a spent time budget.
+
+    Args-
+        model- Model to train, checkpoints are always taken from this (uncompiled) module
+        criterion- Loss function called with (outputs, labels)
+        optimizer- Optimizer over model.parameters()
+        device- Device to train on
+        scheduler- Optional LR scheduler, stepped once per epoch after validation (once per
+            batch for OneCycleLR), built from lr_schedule by fit() when None
+        metrics- Dict of name -> metric from metrics.py (anything with reset(),
+            update(outputs, labels) and compute())
+        prepare_batch- Optional function mapping a loaded (inputs, labels) batch to what
+            the model and criterion expect (reshaping, picking the last frame, ...)
+        monitor- Validation result ('loss' or a metric name) that picks the best weights
+        mode- 'min' or 'max', whether a lower or a higher monitor value is better
+        name- Prefix of the checkpoint files and TensorBoard tags (e.g. 'left')
+        compile- Run the forward pass through torch.compile
+        autocast- Run the forward pass under bfloat16 autocast
+        lr_schedule- Schedule passed to budget.make_scheduler when no scheduler is given
+        budget- Optional BudgetController, by default one with the Config settings
+        export_wrapper- Optional function wrapping the model for the .onnx exports, see
+            inference.fold_scaler for a graph taking and returning raw units
+    """
+    def __init__(self, model, criterion, optimizer, device, metrics=None, prepare_batch=None,
+                 monitor='loss', mode='min', name='', compile=Config['compile'], autocast=Config['autocast'],
+                 scheduler=None, lr_schedule=Config['lr_schedule'], budget=None, export_wrapper=None):
+        self.model = model.to(device)
+        self.forward_model = torch.compile(self.model) if compile else self.model
+        self.criterion = criterion
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        self.lr_schedule = lr_schedule
+        self.budget = budget if budget is not None else BudgetController(monitor, mode)
+        self.device = torch.device(device)
+        self.metrics = metrics or {}
+        self.prepare_batch = prepare_batch
+        self.monitor = monitor
+        self.mode = mode
+        self.name = name
+        self.prefix = name + '_' if name else ''
+        self.export_wrapper = export_wrapper
+        self.autocast = autocast
+        self.dummy_input = None
+        self.writer = SummaryWriter(Config['model_path']) if Config['tensorboard_log'] else None
+
+    def forward(self, inputs, labels):
+        with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.autocast):
+            outputs = self.forward_model(inputs)
+        outputs = outputs.float()
+        return outputs, self.criterion(outputs, labels)
+
+    def run_epoch(self, phase, dataloader):
+        """Runs one pass over dataloader and returns the loss and metrics of the phase"""
+        train = phase == 'train'
+        self.model.train(train)
+        for metric in self.metrics.values():
+            metric.reset()
+        running_loss = torch.zeros((), device=self.device)
+        running_total = 0
+
+        with torch.set_grad_enabled(train):
+            for inputs, labels in tqdm(dataloader):
+                inputs = inputs.to(self.device, non_blocking=True)
+                labels = labels.to(self.device, non_blocking=True)
+                if self.prepare_batch is not None:
+                    inputs, labels = self.prepare_batch(inputs, labels)
+                if self.dummy_input is None:
+                    self.dummy_input = inputs[:1].detach().clone()
+
+                outputs, loss = self.forward(inputs, labels)
+                if train:
+                    self.optimizer.zero_grad(set_to_none=True)
+                    loss.backward()
+                    self.optimizer.step()
+                    if self.scheduler is not None and steps_per_batch(self.scheduler):
+                        self.scheduler.step()
+
+                running_loss += loss.detach() * inputs.shape[0]
+                running_total += inputs.shape[0]
+                for metric in self.metrics.values():
+                    metric.update(outputs.detach(), labels)
+
+        # the only host syncs of the epoch
+        results = {'loss': float(running_loss) / max(running_total, 1)}
+        for name, metric in self.metrics.items():
+            value = metric.compute()
+            if isinstance(value, dict):
+                results.update({name + '_' + key if key else name: v for key, v in value.items()})
+            else:
+                results[name] = value
+        return results
+
+    def log(self, phase, results, epoch):
+        for key, value in results.items():
+            self.writer.add_scalar(self.prefix + phase + '_' + key, value, global_step=epoch)
+        if phase == 'train':
+            self.writer.add_scalar(self.prefix + 'lr', self.optimizer.param_groups[0]['lr'], global_step=epoch)
+        for name, metric in self.metrics.items():
+            # rows are labels, columns predictions
+            matrix = getattr(metric, 'matrix', None)
+            if matrix is not None:
+                self.writer.add_text(self.prefix + phase + '_' + name + '_confusion', str(matrix.tolist()), global_step=epoch)
+
+    def is_better(self, value, best):
+        if best is None:
+            return True
+        return value < best if self.mode == 'min' else value > best
+
+    def checkpoint_path(self, file_name):
+        return os.path.join(Config['model_path'], 'checkpoints', self.prefix + file_name)
+
+    def training_state(self, epoch, model_state, best, best_results, best_wts, dataloaders):
+        """Everything fit() needs to continue after epoch as if it never stopped
+
+        model_state and best_wts are stored as given, they must not change until the state is written
+        """
+        splits = {}
+        for phase, dataloader in dataloaders.items():
+            indices = getattr(dataloader.dataset, 'indices', None)
+            if indices is not None:
+                splits[phase] = [int(idx) for idx in indices]
+        return {
+            'epoch': epoch,
+            'model': model_state,
+            'optimizer': to_cpu(self.optimizer.state_dict()),
+            'scheduler': self.scheduler.state_dict() if self.scheduler is not None else None,
+            'budget': self.budget.state_dict(),
+            'rng': rng_state(),
+            'splits': splits,
+            'best': best,
+            'best_results': best_results,
+            'best_wts': best_wts,
+            'dummy_input': self.dummy_input.detach().cpu() if self.dummy_input is not None else None
+        }
+
+    def fit(self, dataloaders, num_epochs=Config['num_epochs'], checkpoint_every=5, resume=None,
+            clear_checkpoints=Config['clear_checkpoints'], resume_every=Config['resume_every']):
+        """Trains for up to num_epochs and exports the best weights as model_final.pth/.onnx
+
+        Args-
+            dataloaders- Dict with a 'train' and a 'valid' loader
+            num_epochs- Epoch budget, training stops earlier when self.budget says so
+            checkpoint_every- Epochs between two checkpoints added to the CheckpointStore
+            resume- Optional training state from load_training_state(), training continues
+                after its epoch with the same weights, optimizer, scheduler and RNG states
+            clear_checkpoints- Delete the checkpoints of earlier runs from the CheckpointStore when
+                not resuming, otherwise they are kept and ranked together with the new ones
+            resume_every- Epochs between two training states written to resume.pth, checkpoint_every
+                when None. The state of the last epoch is always written
+
+        Returns-
+            The validation results of the best epoch
+        """
+        start_time = datetime.now()
+        if resume_every is None:
+            resume_every = checkpoint_every
+        best = None
+        best_results = None
+        best_wts = snapshot(self.model)
+        store = CheckpointStore(os.path.join(Config['model_path'], 'checkpoints', self.name),
+                                monitor=self.monitor, mode=self.mode)
+        if self.scheduler is None:
+            try:
+                steps_per_epoch = len(dataloaders['train'])
+            except TypeError:
+                steps_per_epoch = None
+            self.scheduler = make_scheduler(self.optimizer, self.lr_schedule, num_epochs, steps_per_epoch, self.mode)
+        self.budget.start()
+        start_epoch = 0
+        if resume is None:
+            if clear_checkpoints:
+                store.clear()
+            elif store.index['checkpoints']:
+                print(f'{self.prefix}Keeping {len(store.index["checkpoints"])} checkpoints of an earlier run in {store.root}, '
+                      "they are ranked with this run's, set Config['clear_checkpoints'] to delete them")
+        else:
+            self.model.load_state_dict(resume['model'])
+            self.optimizer.load_state_dict(resume['optimizer'])
+            if self.scheduler is not None and resume['scheduler'] is not None:
+                self.scheduler.load_state_dict(resume['scheduler'])
+            if 'budget' in resume:
+                self.budget.load_state_dict(resume['budget'])
+            best = resume['best']
+            best_results = resume['best_results']
+            best_wts = resume['best_wts']
+            if resume['dummy_input'] is not None:
+                self.dummy_input = resume['dummy_input'].to(self.device)
+            start_epoch = resume['epoch'] + 1
+            print(f'{self.prefix}Resuming after epoch {resume["epoch"]}')
+        checkpoints = CheckpointWriter(self.model, store, export_wrapper=self.export_wrapper)
+        if resume is not None:
+            # restored last, nothing above may draw random numbers after it
+            set_rng_state(resume['rng'])
+
+        for epoch in range(start_epoch, num_epochs):
+            improved = False
+            for phase in ['train', 'valid']:
+                results = self.run_epoch(phase, dataloaders[phase])
+                print(f'{self.prefix}Epoch {epoch} Phase: {phase} ' + ' '.join(f'{k}: {v:.4f}' for k, v in results.items()))
+                if self.writer is not None:
+                    self.log(phase, results, epoch)
+                if phase == 'valid' and self.is_better(results[self.monitor], best):
+                    best = results[self.monitor]
+                    best_results = results
+                    best_wts = snapshot(self.model, out=best_wts)
+                    improved = True
+            if self.scheduler is not None and not steps_per_batch(self.scheduler):
+                step_scheduler(self.scheduler, results[self.monitor])
+            stop = self.budget.update(epoch, results)
+
+            add = (epoch + 1) % checkpoint_every == 0
+            save_state = (epoch + 1) % resume_every == 0 or stop or epoch == num_epochs - 1
+            if add or save_state:
+                # one snapshot of the epoch, shared by the store and the training state
+                state = checkpoints.snapshot()
+                if add:
+                    checkpoints.add(state, epoch, results, self.dummy_input)
+                if save_state:
+                    # best_wts is overwritten by later improvements, unless it is this epoch's snapshot
+                    saved_best = state if improved else {key: value.clone() for key, value in best_wts.items()}
+                    checkpoints.save_training_state(self.training_state(epoch, state, best, best_results, saved_best, dataloaders),
+                                                    training_state_path(self.name))
+                checkpoints.release(state)
+            if stop:
+                print(f'{self.prefix}Stopping after epoch {epoch}: {self.budget.stop_reason}')
+                break
+
+        print('Training ended, total time:', datetime.now() - start_time)
+        if self.budget.time_to_target is not None:
+            print(f'{self.prefix}Time to validation loss {self.budget.target}: {self.budget.time_to_target:.1f}s '
+                  f'(epoch {self.budget.epoch_to_target})')
+            if self.writer is not None:
+                self.writer.add_scalar(self.prefix + 'time_to_target', self.budget.time_to_target,
+                                       global_step=self.budget.epoch_to_target)
+        self.model.load_state_dict(best_wts)
+        checkpoints.save(best_wts, self.checkpoint_path('model_final.pth'),
+                         self.checkpoint_path('model_final.onnx'), self.dummy_input)
+        checkpoints.close()
+        if self.writer is not None:
+            self.writer.close()
+        return best_results
+
+
+def training_arguments(description=None):
+    """Command line arguments shared by the train_*.py scripts"""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from the last training state in <model_path>/checkpoints')
+    return parser
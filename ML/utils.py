@@ -11,3 +11,41 @@ Config['num_epochs']=1000
 Config['batch_size']=256
 Config['num_workers']=2
 Config['data_type'] = 'relative' # one of "euler/quaternion/both/relative"
+
+Config['use_cache']=True
+Config['cache_path']='Data_Cache' # columnar copies of the session CSVs, rebuilt when a CSV changes
+Config['rows_per_grab']=0 # rows before each grab that GrabCSVDataset labels with that grab
+
+Config['streaming']=False # stream the sessions with StreamingCSVDataset instead of loading them into memory
+Config['stream_chunk_rows']=65536
+Config['stream_shuffle_buffer']=10000
+Config['stream_split_block_rows']=2048 # frames of a session that go to the same side of a streamed train/valid split
+Config['num_ingest_workers']=4 # processes reading session CSVs in parallel, 0 reads them in the main process
+Config['device_loader']=False # keep the whole dataset on the training device and batch it without DataLoader workers
+
+Config['weight_decay']=2e-5 # L2 penalty of the optimizers, same as adding 1e-5*sum(||p||^2) to the loss
+Config['compile']=False # run the forward pass through torch.compile
+Config['autocast']=False # run the forward pass under bfloat16 autocast (CPU or GPU)
+
+Config['onnx_raw_units']=False # fold scaler.json into the exported .onnx so that it takes and returns raw units
+Config['async_checkpoint']=True # write .pth/.onnx checkpoints on a background thread
+Config['checkpoint_queue_depth']=2 # checkpoints waiting to be written before training blocks
+Config['checkpoint_top_k']=3 # best checkpoints by validation result kept in the checkpoint store
+Config['checkpoint_keep_last']=2 # latest checkpoints kept in the checkpoint store
+Config['clear_checkpoints']=False # a new (not resumed) run deletes the checkpoints of earlier runs into the same model_path
+Config['resume_every']=None # epochs between two training states written to resume.pth, None writes one with every checkpoint
+
+Config['lr_schedule']=None # None (constant lr), 'plateau' (ReduceLROnPlateau), 'onecycle' or 'cosine'
+Config['plateau_patience']=10 # epochs without improvement before the plateau schedule lowers the lr
+Config['plateau_factor']=0.5
+Config['early_stopping_patience']=None # epochs without improvement of the monitored validation result before training stops, None to disable
+Config['early_stopping_min_delta']=0.0 # smallest change of the monitored result that counts as an improvement
+Config['max_train_time']=None # wall-clock budget of a run in seconds, None for no limit
+Config['target_loss']=None # validation loss whose time to reach is recorded, None to disable
+
+Config['serve_host']='127.0.0.1' # serve.py only listens on localhost by default
+Config['serve_port']=5005 # TCP port of serve.py, the UDP port is serve_port+1
+Config['serve_max_batch']=64 # frames of concurrent sessions run through a model as one batch
+Config['serve_max_delay_ms']=1.0 # longest a frame waits for frames of other sessions to join its batch
+Config['serve_session_timeout_s']=30.0 # a UDP session idle this long is forgotten, its next frame starts a new history
+Config['headset_fps']=72 # frame rate at which loadtest.py replays a recorded session to the server